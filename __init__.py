@@ -1,7 +1,13 @@
 # Copyright (C) 2015 Idein Inc.
 # Author: koichi
 
-from .actor import Actor, ThreadingActor, ProcessActor,\
-        send, get, getall, broadcast, stopall
+from .actor import Actor, ThreadingActor, ProcessActor, PooledActor,\
+        AsyncActor, Dispatcher, ProcessPool, Future, Mailbox, MailboxFull,\
+        ActorRef, ActorMetrics, Registry, send, send_many, get, ref, getall,\
+        broadcast, subscribe, unsubscribe, publish, stopall, overflows,\
+        metrics, set_dispatcher, set_handler_hook, get_event_loop,\
+        get_process_pool,\
+        PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_SYSTEM
+from .profiler import HandlerProfiler
 from .scheduler import Scheduler
 from .websocket import WebSocket
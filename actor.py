@@ -2,41 +2,398 @@
 # Author: koichi
 
 #== Implementation of Actor model ==
-# This module provides two kinds of implementations: threads and processes.
+# This module provides three kinds of implementations: threads, asyncio
+# and processes.
 
+import os
 import sys
+import inspect
+import asyncio
 import threading
 import queue
-import uuid
+import time
+import itertools
+import heapq
+import collections
+import concurrent.futures
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.reduction import ForkingPickler
+import array
 from carnival.logging import logger
 
 _QUEUE_TIMEOUT = 5 # timeout of fetching message from queues
+_SEND_TIMEOUT = 5 # default max time a sender waits for a full mailbox
+_DISPATCH_BATCH = 16 # max number of messages processed per dispatch
+_SHM_THRESHOLD = 64 * 1024 # min size of buffers passed via shared memory
 
-class Future(object):
-    def __init__(self, func):
-        self._value = None
-        self._lock = threading.Lock()
-        self._thread = threading.Thread(target=self._set, args=(func,))
-        self._thread.start()
+class MailboxFull(RuntimeError):
+    pass
 
-    def _set(self, func):
-        v = func()
-        with self._lock:
-            self._value = v
+# Message priorities. Messages of higher priority are taken first,
+# messages of the same priority in FIFO order.
+PRIORITY_LOW    = -10
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH   = 10
+PRIORITY_SYSTEM = 100
+
+# Thread safe mailbox with a FIFO lane per priority.
+# Unlike queue.Queue, a batch of messages can be put or taken with a single
+# lock acquisition.
+#
+# capacity: max number of queued messages. 0 means unbounded.
+# overflow: policy applied when a message is put into a full mailbox.
+#   'block'    wait at most `timeout` sec. (forever if None) for a free slot,
+#              then raise MailboxFull. Senders running on the thread which
+#              consumes the mailbox (`owner`) or on an event loop can not
+#              wait and get MailboxFull at once. `wakeup` is called before
+#              waiting so that a suspended consumer is started.
+#   'drop_new' discard the new message
+#   'drop_old' discard the oldest queued message of the lowest priority
+#   'reject'   raise MailboxFull
+# Control messages are never refused. `overflows` counts the discarded and
+# refused messages. Requests which are discarded fail with MailboxFull.
+#
+# Messages are stamped when queued. `peak` is the max number of queued
+# messages and `waits` holds [count, total, max] of the time spent queued
+# per tag.
+#
+# Coalescing: coalesce(tag, key) declares a key function for messages of
+# `tag`. A new message whose key (not None) equals the key of a message
+# still queued replaces that message's mail in place. `coalesced` counts the
+# replaced messages. Requests are never coalesced.
+class Mailbox(object):
+    OVERFLOW_POLICIES = ('block', 'drop_new', 'drop_old', 'reject')
+
+    def __init__(self, capacity=0, overflow='block', timeout=_SEND_TIMEOUT,
+            wakeup=None):
+        if overflow not in Mailbox.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy', overflow)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.timeout = timeout
+        self.wakeup = wakeup
+        self.owner = None # ident of the thread consuming the mailbox
+        self.overflows = 0
+        self.coalesced = 0
+        self.peak = 0
+        self.waits = {}
+        self._keys = {}    # tag -> key function
+        self._queued = {}  # (tag, key) -> queued [tag, mail]
+        self._items = collections.deque() # lane of PRIORITY_NORMAL
+        self._lanes = {PRIORITY_NORMAL: self._items}
+        self._order = [self._items] # lanes from the highest priority
+        lock = threading.Lock()
+        self._not_empty = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+
+    def put(self, item, control=False, priority=PRIORITY_NORMAL):
+        self.put_many([item], control, priority)
+
+    def put_many(self, items, control=False, priority=PRIORITY_NORMAL):
+        now = time.monotonic()
+        items = [(tag, mail, now) for tag, mail in items]
+        discarded = ()
+        with self._not_empty:
+            if self._keys:
+                items = self._coalesce(items)
+                if not items:
+                    return
+            lane = self._lanes.get(priority)
+            if lane is None:
+                lane = self._add_lane(priority)
+            if self.capacity and not control:
+                discarded = self._put_bounded(lane, items)
+            else:
+                lane.extend(items)
+            size = self.qsize()
+            if size > self.peak:
+                self.peak = size
+            self._not_empty.notify()
+        # outside the lock; callbacks of the failed requests may send to
+        # this mailbox
+        for item in discarded:
+            _discard(item)
+
+    def coalesce(self, tag, key):
+        with self._not_empty:
+            if key is None:
+                self._keys.pop(tag, None)
+            else:
+                self._keys[tag] = key
+
+    # Returns the items to be queued. Items with a key are queued as mutable
+    # [tag, mail, time] so that newer messages can replace the mail.
+    def _coalesce(self, items):
+        new = []
+        for item in items:
+            tag, mail, t = item
+            f = self._keys.get(tag)
+            if f is None or (isinstance(mail, dict) and 'reply_tag' in mail):
+                new.append(item)
+                continue
+            k = f(mail)
+            if k is None:
+                new.append(item)
+                continue
+            entry = self._queued.get((tag, k))
+            if entry is not None:
+                entry[1] = mail
+                self.coalesced += 1
+            else:
+                entry = self._queued[(tag, k)] = [tag, mail, t]
+                new.append(entry)
+        return new
+
+    # called when a queued item is taken or discarded
+    def _forget(self, items):
+        for item in items:
+            if type(item) is list:
+                tag, mail, _ = item
+                k = (tag, self._keys[tag](mail)) if tag in self._keys else None
+                if self._queued.get(k) is item:
+                    del self._queued[k]
+
+    def _add_lane(self, priority):
+        lane = self._lanes[priority] = collections.deque()
+        self._order = [self._lanes[p]
+                for p in sorted(self._lanes, reverse=True)]
+        return lane
+
+    # Returns the discarded items.
+    def _put_bounded(self, lane, items):
+        free = max(0, self.capacity - self.qsize())
+        discarded = []
+        if len(items) <= free:
+            lane.extend(items)
+        elif self.overflow == 'reject':
+            self.overflows += len(items)
+            self._forget(items)
+            raise MailboxFull('Mailbox is full', self.capacity)
+        elif self.overflow == 'drop_new':
+            lane.extend(items[:free])
+            self.overflows += len(items) - free
+            self._forget(items[free:])
+            discarded = items[free:]
+        elif self.overflow == 'drop_old':
+            lane.extend(items)
+            excess = self.qsize() - self.capacity
+            for lane in reversed(self._order):
+                for item in list(itertools.islice((item for item in lane
+                        if not item[0].startswith('actor:')), excess)):
+                    lane.remove(item)
+                    excess -= 1
+                    self.overflows += 1
+                    self._forget([item])
+                    discarded.append(item)
+                if excess <= 0:
+                    break
+        else:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.monotonic() + self.timeout
+            for i, item in enumerate(items):
+                if self.qsize() >= self.capacity:
+                    if threading.get_ident() == self.owner or _in_event_loop():
+                        self.overflows += len(items) - i
+                        self._forget(items[i:])
+                        raise MailboxFull('Mailbox is full', self.capacity)
+                    if self.wakeup:
+                        self.wakeup()
+                    self._not_empty.notify()
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline - time.monotonic()
+                    if not self._not_full.wait_for(
+                            lambda: self.qsize() < self.capacity, timeout):
+                        self.overflows += len(items) - i
+                        self._forget(items[i:])
+                        raise MailboxFull('Mailbox is full', self.capacity)
+                lane.append(item)
+        return discarded
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block, timeout)[0]
+
+    # Take at most `limit` messages as (tag, mail).
+    # Blocks only until the first one arrives.
+    def get_many(self, limit, block=True, timeout=None):
+        with self._not_empty:
+            if self.empty():
+                if not block or not self._not_empty.wait_for(
+                        lambda: not self.empty(), timeout):
+                    raise queue.Empty
+            items = []
+            for lane in self._order:
+                n = min(limit - len(items), len(lane))
+                items.extend(lane.popleft() for _ in range(n))
+                if len(items) == limit:
+                    break
+            if self._queued:
+                self._forget(items)
+            if self.capacity:
+                self._not_full.notify_all()
+
+            now = time.monotonic()
+            waits = self.waits
+            mails = []
+            for tag, mail, t in items:
+                w = waits.get(tag)
+                if w is None:
+                    w = waits[tag] = [0, 0.0, 0.0]
+                wait = now - t
+                w[0] += 1
+                w[1] += wait
+                if wait > w[2]:
+                    w[2] = wait
+                mails.append((tag, mail))
+            return mails
+
+    def wait_stats(self):
+        with self._not_empty:
+            return {tag: list(w) for tag, w in self.waits.items()}
+
+    def empty(self):
+        if len(self._order) == 1:
+            return not self._items
+        return not any(self._order)
+
+    def qsize(self):
+        if len(self._order) == 1:
+            return len(self._items)
+        return sum(len(lane) for lane in self._order)
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+# fail the request of a discarded message
+def _discard(item):
+    tag, mail = item[0], item[1]
+    if isinstance(mail, dict) and 'reply_tag' in mail and not mail.get('reply_to'):
+        Future.resolve(mail['reply_tag'], None, MailboxFull('Discarded', tag))
+
+# Deadlines of request futures, expired by a timer thread of their own so
+# that timeouts do not depend on the event loop or any handler being
+# responsive. Entries hold only the tag of the future; entries of futures
+# which were resolved are dropped when they outnumber the pending ones.
+class _Deadlines(object):
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def add(self, timeout, tag):
+        entry = (time.monotonic() + timeout, tag)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if len(self._heap) > 2 * len(Future._pending) + 64:
+                self._heap = [e for e in self._heap if e[1] in Future._pending]
+                heapq.heapify(self._heap)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+                _, tag = heapq.heappop(self._heap)
+            future = Future._pending.pop(tag, None)
+            if future is not None:
+                future._expire()
+
+# Result of Actor.request.
+# Futures waiting for replies are kept in a per-process correlation table
+# keyed by reply tag and resolved directly by the actor which handled the
+# request. Compatible with concurrent.futures and awaitable from coroutines.
+#
+# The timeout of a request is enforced by _Deadlines, which removes the
+# entry and fails the future with TimeoutError, so that awaiting, result()
+# and callbacks see the timeout as well as get().
+#
+# Tags are (pid, n) so that tags of futures of worker processes never equal
+# the tags of requests of the parent they reply to.
+class Future(concurrent.futures.Future):
+    _pending = {}
+    _counter = itertools.count()
+    _deadlines = _Deadlines()
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.tag = (os.getpid(), next(Future._counter))
+        self._expired = False
+        Future._pending[self.tag] = self
+        if timeout is not None:
+            Future._deadlines.add(timeout, self.tag)
+
+    @classmethod
+    def resolve(cls, tag, value=None, exc=None):
+        future = cls._pending.pop(tag, None)
+        if future is None or future.done():
+            return False
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(value)
+        return True
 
+    # remove the entry of a request which was not sent
+    def _forget(self):
+        Future._pending.pop(self.tag, None)
+
+    # called by _Deadlines after removing the entry
+    def _expire(self):
+        if self.done():
+            return
+        self._expired = True
+        self.set_exception(concurrent.futures.TimeoutError(
+            '%s: request timeout' % self))
+
+    # Returns the reply. Returns None if the reply did not arrive within the
+    # timeout of the request, raises RuntimeError if it did not arrive within
+    # `timeout`.
     def get(self, timeout=None):
-        self._thread.join(timeout)
-        if self._thread.is_alive():
-            raise RuntimeError('%s: timeout', self)
-        return self._value
+        try:
+            return self.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if not self._expired:
+                raise RuntimeError('%s: timeout' % self)
+            return None
 
     def wait(self, timeout=None):
         self.get(timeout)
 
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
 # registry of all actors. thread safe.
+# Writers update the indexes in place under `_lock`; lookups by id take no
+# lock. Iterations use snapshots (tuples) of the indexes, which are taken
+# under the lock when first needed after a write, so that a write costs
+# O(1) per index and a run of writes is followed by a single snapshot.
+#
+# Registered actors are indexed by every class of their MRO so that
+# getall/broadcast by class touch only the instances of the class.
+# Actors (named or anonymous) subscribe to topics and publish sends to the
+# subscribers.
 class Registry(object):
     _dict = {}
+    _by_class = {}         # class -> {id(actor): actor}
+    _topics = {}           # topic -> {id(actor): actor}
+    _class_snapshots = {}  # class -> tuple of actors; dropped on writes
+    _topic_snapshots = {}  # topic -> tuple of actors; dropped on writes
     _lock = threading.Lock()
 
     @classmethod
@@ -45,33 +402,58 @@ class Registry(object):
             if actor.id in cls._dict:
                 raise RuntimeError('Duplicated actor ID', actor.id)
             cls._dict[actor.id] = actor
+            for klass in type(actor).__mro__:
+                cls._by_class.setdefault(klass, {})[id(actor)] = actor
+                cls._class_snapshots.pop(klass, None)
+            actor._registered = True
         logger.debug('Registered %s', actor)
 
     @classmethod
     def unregistor(cls, actor):
         with cls._lock:
-            if actor.id in cls._dict:
+            if cls._dict.get(actor.id) is actor:
                 del cls._dict[actor.id]
+                for klass in type(actor).__mro__:
+                    members = cls._by_class[klass]
+                    del members[id(actor)]
+                    if not members:
+                        del cls._by_class[klass]
+                    cls._class_snapshots.pop(klass, None)
+                cls._remove_subscriber(actor, actor._topics)
+                actor._topics = set()
+                actor._registered = False
                 logger.debug('Unregistered %s', actor)
 
+    # tuple of the actors of index[key], kept in `snapshots` until a write
+    @classmethod
+    def _snapshot(cls, snapshots, index, key):
+        actors = snapshots.get(key)
+        if actors is None:
+            with cls._lock:
+                actors = snapshots.get(key)
+                if actors is None:
+                    members = index.get(key)
+                    actors = tuple(members.values()) if members else ()
+                    snapshots[key] = actors
+        return actors
+
+    # every registered actor is an instance of object
+    @classmethod
+    def _members(cls, klass):
+        return cls._snapshot(cls._class_snapshots, cls._by_class,
+                object if klass is None else klass)
+
     @classmethod
     def get(cls, id):
-        with cls._lock:
-            return cls._dict.get(id, None)
+        return cls._dict.get(id, None)
 
     @classmethod
     def getall(cls, klass=None):
-        with cls._lock:
-            if klass is None:
-                return list(cls._dict.values())
-            else:
-                return [actor for actor in cls._dict.values()
-                        if isinstance(actor, klass)]
+        return list(cls._members(klass))
 
     @classmethod
     def broadcast(cls, tag, mail=None, klass=None):
-        actors = cls.getall(klass=klass)
-        for actor in actors:
+        for actor in cls._members(klass):
             actor.send(tag, mail)
 
     @classmethod
@@ -80,68 +462,323 @@ class Registry(object):
         for actor in actors:
             actor._actor_stop()
 
+    @classmethod
+    def subscribe(cls, actor, topic):
+        with cls._lock:
+            if topic in actor._topics:
+                return
+            cls._topics.setdefault(topic, {})[id(actor)] = actor
+            cls._topic_snapshots.pop(topic, None)
+            actor._topics.add(topic)
+
+    @classmethod
+    def unsubscribe(cls, actor, topic):
+        with cls._lock:
+            if topic in actor._topics:
+                cls._remove_subscriber(actor, [topic])
+                actor._topics.discard(topic)
+
+    # called with _lock held
+    @classmethod
+    def _remove_subscriber(cls, actor, topics):
+        for topic in topics:
+            members = cls._topics.get(topic)
+            if members is not None:
+                members.pop(id(actor), None)
+                if not members:
+                    del cls._topics[topic]
+            cls._topic_snapshots.pop(topic, None)
+
+    @classmethod
+    def subscribers(cls, topic):
+        return list(cls._snapshot(cls._topic_snapshots, cls._topics, topic))
+
+    # Send `mail` to the subscribers of `topic` with `tag` (`topic` if None).
+    @classmethod
+    def publish(cls, topic, mail=None, tag=None):
+        tag = topic if tag is None else tag
+        for actor in cls._snapshot(cls._topic_snapshots, cls._topics, topic):
+            actor.send(tag, mail)
+
+    # drop the state inherited from the parent by fork()
+    @classmethod
+    def _reset(cls):
+        cls._dict, cls._by_class, cls._topics = {}, {}, {}
+        cls._class_snapshots, cls._topic_snapshots = {}, {}
+        cls._lock = threading.Lock()
+
+# Handle of a named actor.
+# The actor is looked up once and cached until it is unregistered, so
+# senders keeping an ActorRef skip the registry on every message.
+# Picklable: only the id is serialized.
+class ActorRef(object):
+    __slots__ = ('id', '_actor')
+
+    def __init__(self, id, actor=None):
+        self.id = id
+        self._actor = actor
+
+    def resolve(self):
+        actor = self._actor
+        if actor is None or not actor._registered:
+            actor = self._actor = Registry.get(self.id)
+        return actor
+
+    def send(self, tag, mail=None, priority=None):
+        actor = self.resolve()
+        if actor:
+            actor.send(tag, mail, priority)
+        else:
+            send(self.id, tag, mail, priority)
+
+    def send_many(self, tag, mails, priority=None):
+        actor = self.resolve()
+        if actor:
+            actor.send_many(tag, mails, priority)
+        else:
+            send_many(self.id, tag, mails, priority)
+
+    def request(self, tag, mail=None, timeout=None):
+        actor = self.resolve()
+        if actor:
+            return actor.request(tag, mail, timeout)
+        if _parent:
+            return _parent.request(self.id, tag, mail, timeout)
+        raise RuntimeError('Actor not found', self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, ActorRef) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __reduce__(self):
+        return (ActorRef, (self.id,))
+
+    def __repr__(self):
+        return '<ActorRef: %s>' % self.id
+
 def get(id):
     return Registry.get(id)
 
-def getall(klass=None):
-    return Registry.getall(klass)
+def ref(id):
+    return ActorRef(id)
 
 def getall(klass=None):
     return Registry.getall(klass)
 
-def broadcast(tag, mail=None, klss=None):
+def broadcast(tag, mail=None, klass=None):
     Registry.broadcast(tag, mail, klass)
 
+def subscribe(actor, topic):
+    Registry.subscribe(actor, topic)
+
+def unsubscribe(actor, topic):
+    Registry.unsubscribe(actor, topic)
+
+def publish(topic, mail=None, tag=None):
+    Registry.publish(topic, mail, tag)
+
 def stopall(klass=None):
     Registry.stopall(klass)
 
+# Hook called instead of handlers as hook(actor, tag, handler, mail).
+# It must call handler(mail) and return its result. See carnival.profiler.
+_handler_hook = None
+
+def set_handler_hook(hook):
+    global _handler_hook
+    _handler_hook = hook
+
+# metrics of registered actors by id. Never blocks; ProcessActors report
+# their last snapshot (see ProcessActor.metrics).
+def metrics(klass=None):
+    return {actor.id: actor.metrics() for actor in Registry.getall(klass)}
+
+# overflow counts of registered actors whose mailboxes overflowed
+def overflows(klass=None):
+    return {actor.id: actor.overflows for actor in Registry.getall(klass)
+            if actor.overflows}
+
+_HISTOGRAM_BUCKETS = 32
+
+# Runtime metrics of an actor.
+# Updated only by the thread running the actor; snapshot() may be called
+# from any thread. handlers maps tag to [count, total time, max time,
+# histogram]. Bucket i of the histogram counts handler calls which took
+# less than 2**i microseconds (and at least 2**(i-1)).
+class ActorMetrics(object):
+    def __init__(self):
+        self.activations = 0
+        self.suspensions = 0
+        self.failures = 0
+        self.handlers = {}
+
+    def record(self, tag, elapsed, count=1):
+        h = self.handlers.get(tag)
+        if h is None:
+            h = self.handlers[tag] = [0, 0.0, 0.0, [0] * _HISTOGRAM_BUCKETS]
+        h[0] += count
+        h[1] += elapsed
+        if elapsed > h[2]:
+            h[2] = elapsed
+        h[3][min(int(elapsed * 1e6).bit_length(), _HISTOGRAM_BUCKETS - 1)] += 1
+
+    def snapshot(self, mailbox=None):
+        tags = {}
+        for tag, (count, total, max_time, hist) in list(self.handlers.items()):
+            tags[tag] = {
+                'processed': count,
+                'handler_time': {
+                    'total': total,
+                    'max': max_time,
+                    'histogram': {2 ** i / 1e6: n
+                        for i, n in enumerate(hist) if n},
+                    },
+                }
+        stats = {
+            'activations': self.activations,
+            'suspensions': self.suspensions,
+            'failures': self.failures,
+            'tags': tags,
+            }
+        if mailbox is not None:
+            stats['depth'] = mailbox.qsize()
+            stats['peak_depth'] = mailbox.peak
+            stats['overflows'] = mailbox.overflows
+            stats['coalesced'] = mailbox.coalesced
+            for tag, (count, total, max_time) in mailbox.wait_stats().items():
+                t = tags.setdefault(tag, {'processed': 0})
+                t['queue_time'] = {'count': count, 'total': total, 'max': max_time}
+        return stats
+
 # The base class of all actor objects.
 # **Do not instantiate this class directly.**
+#
+# Batch mode: set `batch_size` > 1 to take up to that many queued messages
+# per wakeup. Override `handle_batch` to receive runs of consecutive user
+# messages as a list of (tag, mail) instead of one by one. Control messages
+# (actor:*) and requests are always processed individually.
+#
+# Priority: messages are queued by priority (see Mailbox). send takes an
+# explicit priority, otherwise `priority_tags` (tag -> priority) and then
+# _SYSTEM_PRIORITIES decide. actor:listen/unlisten/stop are taken before
+# queued user messages. A stop is recorded when it is taken and suspends
+# the actor once the mailbox is empty, so messages arriving while the
+# backlog is processed are processed as well; the priority does not make
+# a stop take effect sooner.
+#
+# Coalescing: `coalesce_keys` (tag -> key function), coalesce() or the
+# `coalesce` argument of listen declare key functions. Queued messages of the
+# tag with the same key are replaced by newer ones (see Mailbox).
+#
+# Metrics: metrics() returns a snapshot of ActorMetrics and mailbox
+# statistics. Runs of an overridden handle_batch are recorded under the tag
+# 'actor:batch'.
+#
+# Bounded mailbox: set `mailbox_size` > 0 and choose the `overflow` policy
+# (see Mailbox). `send_timeout` is the max time a sender is blocked by the
+# 'block' policy.
+_SYSTEM_PRIORITIES = {
+    'actor:stop': PRIORITY_SYSTEM,
+    'actor:listen': PRIORITY_SYSTEM,
+    'actor:unlisten': PRIORITY_SYSTEM
+    }
+
 class Actor(object):
+    priority_tags = {}
+    coalesce_keys = {}
+    batch_size = 1
+    mailbox_size = 0
+    overflow = 'block'
+    send_timeout = _SEND_TIMEOUT
+
     def __init__(self, id=None):
         self.id = id
+        self._setup()
+        for tag, key in self.coalesce_keys.items():
+            self.coalesce(tag, key)
+        if id is not None:
+            Registry.registor(self)
+
+    def _setup(self):
         self._mailbox = self._create_mailbox()
         self._running = threading.Event()
+        self._state_lock = threading.Lock()
+        self._resumed = False
+        self._stopping = False
+        self._registered = False
+        self._topics = set()
+        self._metrics = ActorMetrics()
         self._handlers = {
             'actor:listen': self._listen,
-            'actor:unlisten': self._unlisten
+            'actor:unlisten': self._unlisten,
+            'actor:release': self._release,
+            'actor:metrics': self._metrics_snapshot
             }
-        if id is not None:
-            Registry.registor(self)
 
-    def listen(self, tag, handler):
+    def metrics(self):
+        return self._metrics.snapshot(self._mailbox)
+
+    def ref(self):
+        if self.id is None:
+            raise RuntimeError('Anonymous actor has no reference', self)
+        return ActorRef(self.id, self)
+
+    # receive messages published to `topic`
+    def subscribe(self, topic):
+        Registry.subscribe(self, topic)
+
+    def unsubscribe(self, topic):
+        Registry.unsubscribe(self, topic)
+
+    def listen(self, tag, handler, coalesce=None):
+        if coalesce:
+            self.coalesce(tag, coalesce)
         self.send('actor:listen', {'tag': tag, 'handler': handler})
 
+    # Replace queued messages of `tag` having the same key(mail).
+    # key=None stops coalescing.
+    def coalesce(self, tag, key):
+        self._mailbox.coalesce(tag, key)
+
     def unlisten(self, tag):
         self.send('actor:unlisten', {'tag': tag})
 
-    def send(self, tag, mail=None):
+    def send(self, tag, mail=None, priority=None):
+        self._mailbox.put((tag, mail), tag.startswith('actor:'),
+                self._priority(tag, priority))
         if not self._running.is_set():
             self._start_actor()
-        self._mailbox.put((tag, mail))
 
-    def request(self, tag, mail=None, timeout=None):
-        if not self.id:
-            raise RuntimeError('Anonymous actor cant send a request', self)
-        mailbox = self._create_mailbox(1)
-        id = uuid.uuid4().urn
-        reply_tag = 'reply:' + id
-
-        def _set(mail):
-            mailbox.put(mail['value'])
+    # Enqueue messages `tag` with each of `mails` at once.
+    def send_many(self, tag, mails, priority=None):
+        self._mailbox.put_many([(tag, mail) for mail in mails],
+                tag.startswith('actor:'), self._priority(tag, priority))
+        if not self._running.is_set():
+            self._start_actor()
 
-        self.listen(reply_tag, _set)
-        self.send(tag, dict(mail or [], reply_to=self.id, reply_tag=reply_tag))
+    def _priority(self, tag, priority):
+        if priority is not None:
+            return priority
+        priority = self.priority_tags.get(tag)
+        if priority is not None:
+            return priority
+        return _SYSTEM_PRIORITIES.get(tag, PRIORITY_NORMAL)
 
-        def _get():
-            try:
-                value = mailbox.get(block=True, timeout=timeout)
-            except queue.Empty:
-                value = None
-            self.unlisten(reply_tag)
-            return value
+    # number of messages discarded or refused by the bounded mailbox
+    @property
+    def overflows(self):
+        return getattr(self._mailbox, 'overflows', 0)
 
-        return Future(_get)
+    def request(self, tag, mail=None, timeout=None):
+        future = Future(timeout)
+        try:
+            self.send(tag, dict(mail or [], reply_tag=future.tag))
+        except BaseException:
+            future._forget()
+            raise
+        return future
 
     def _listen(self, mail):
         self._handlers[mail['tag']] = mail['handler']
@@ -151,6 +788,13 @@ class Actor(object):
         if tag in self._handlers:
             del self._handlers[tag]
 
+    def _metrics_snapshot(self, mail):
+        return self._metrics.snapshot(self._mailbox)
+
+    # release shared memory of the messages received from worker processes
+    def _release(self, mail):
+        _release_buffers(mail['segments'])
+
     def on_resume(self):
         pass
 
@@ -160,10 +804,15 @@ class Actor(object):
     def on_fail(self, exc_type, exc_value, traceback):
         pass
 
+    def handle_batch(self, mails):
+        for tag, mail in mails:
+            self._process(tag, mail)
+
     def _start_actor(self):
-        if self._running.is_set():
-            return
-        self._running.set()
+        with self._state_lock:
+            if self._running.is_set():
+                return
+            self._running.set()
         self._start_loop()
 
     def _actor_stop(self):
@@ -171,38 +820,181 @@ class Actor(object):
             self.send('actor:stop')
 
     def _main_loop(self):
-        logger.debug('Start %s', self)
-        self.on_resume()
         while True:
-            try:
-                tag, mail = self._mailbox.get(block=True, timeout=_QUEUE_TIMEOUT)
-                if tag == 'actor:stop':
+            self._resume()
+            self._mailbox.owner = threading.get_ident()
+            while True:
+                try:
+                    mails = self._next_mails(self.batch_size,
+                            timeout=_QUEUE_TIMEOUT)
+                except queue.Empty:
+                    break
+                if not self._process_batch(mails):
                     break
+            if self._suspend():
+                break
 
-                reply_to = reply_tag = None
-                if mail:
-                    reply_to  = mail.pop('reply_to', None)
-                    reply_tag = mail.pop('reply_tag', None)
+    # Process at most `limit` messages and yield the thread.
+    # Used by Dispatcher. Returns True if the actor has to be scheduled again.
+    def _run_batch(self, limit):
+        self._resume()
+        self._mailbox.owner = threading.get_ident()
+        try:
+            mails = self._next_mails(limit, block=False)
+        except queue.Empty:
+            mails = []
+        if self._process_batch(mails) and len(mails) == limit:
+            return True
+        return not self._suspend()
 
-                response = self._handle(tag, mail)
+    def _next_mails(self, limit, block=True, timeout=None):
+        return self._mailbox.get_many(limit, block, timeout)
 
-                if reply_to and reply_tag:
-                    send(reply_to, reply_tag, {'value': response})
-            except queue.Empty:
-                break
-            except Exception:
-                self._fail(*sys.exc_info())
-                try:
-                    self.on_fail(*sys.exc_info())
-                except Exception:
-                    self._fail(*sys.exc_info())
-        self._running.clear()
+    # Returns False if the actor is requested to stop. The stop takes effect
+    # after the rest of the batch is processed and the mailbox is drained.
+    def _process_batch(self, mails):
+        if len(mails) == 1:
+            tag, mail = mails[0]
+            if tag == 'actor:stop':
+                self._stopping = True
+                return self._keep_running()
+            self._process(tag, mail)
+            return not self._stopping or self._keep_running()
+
+        run = []
+        for tag, mail in mails:
+            if self._batchable(tag, mail):
+                run.append((tag, mail))
+                continue
+            self._handle_run(run)
+            run = []
+            if tag == 'actor:stop':
+                self._stopping = True
+            else:
+                self._process(tag, mail)
+        self._handle_run(run)
+        return self._keep_running()
+
+    # control messages and requests are processed individually
+    @staticmethod
+    def _batchable(tag, mail):
+        return not (tag.startswith('actor:') or
+                (isinstance(mail, dict) and 'reply_tag' in mail))
+
+    def _keep_running(self):
+        if self._stopping and self._drained():
+            self._stopping = False
+            return False
+        return True
+
+    def _drained(self):
+        return self._mailbox.empty()
+
+    # Runs are recorded under 'actor:batch' only if handle_batch is
+    # overridden; the default one records each message under its tag.
+    def _handle_run(self, mails):
+        if not mails:
+            return
+        if type(self).handle_batch is Actor.handle_batch:
+            for tag, mail in mails:
+                self._process(tag, mail)
+            return
+        start = time.perf_counter()
+        try:
+            self.handle_batch(mails)
+        except Exception:
+            self._recover()
+        self._metrics.record('actor:batch', time.perf_counter() - start,
+                len(mails))
+
+    def _resume(self):
+        if not self._resumed:
+            self._resumed = True
+            logger.debug('Start %s', self)
+            self._metrics.activations += 1
+            self.on_resume()
+
+    # Returns False if new messages arrived while suspending.
+    # on_suspend is called before releasing the actor so that it never runs
+    # concurrently with the next activation.
+    #
+    # Senders check `_running` without the lock, so a message put after the
+    # emptiness check may have seen the actor running. The mailbox is checked
+    # again after `_running` is cleared and the actor takes itself back
+    # unless such a sender already restarted it.
+    def _suspend(self):
+        self._resumed = False
+        self._mailbox.owner = None
+        self._metrics.suspensions += 1
         self.on_suspend()
         logger.debug('Suspended %s', self)
+        with self._state_lock:
+            if not self._mailbox.empty():
+                return False
+            self._running.clear()
+        if self._mailbox.empty():
+            return True
+        with self._state_lock:
+            if self._running.is_set():
+                return True
+            self._running.set()
+        return False
+
+    def _process(self, tag, mail):
+        reply_to, reply_tag = self._reply_address(mail)
+        start = time.perf_counter()
+        try:
+            response = self._handle(tag, mail)
+            self._reply(reply_to, reply_tag, response)
+        except Exception as e:
+            self._reply(reply_to, reply_tag, None, e)
+            self._recover()
+        self._metrics.record(tag, time.perf_counter() - start)
+
+    def _reply_address(self, mail):
+        if mail:
+            return mail.pop('reply_to', None), mail.pop('reply_tag', None)
+        return None, None
+
+    # Replies to `reply_to` actor if given, otherwise to the Future waiting
+    # for `reply_tag`. A concurrent.futures.Future response (e.g. of work
+    # submitted to an executor by the handler) is replied when it completes.
+    def _reply(self, reply_to, reply_tag, response, exc=None):
+        if isinstance(response, concurrent.futures.Future):
+            response.add_done_callback(
+                lambda f: self._reply_future(reply_to, reply_tag, f))
+            return
+        if reply_tag is None:
+            return
+        if not reply_to:
+            if not Future.resolve(reply_tag, response, exc) and _parent:
+                _parent.reply(reply_tag, response, exc)
+        elif exc is None:
+            send(reply_to, reply_tag, {'value': response})
+
+    def _reply_future(self, reply_to, reply_tag, future):
+        if future.cancelled():
+            exc = concurrent.futures.CancelledError()
+        else:
+            exc = future.exception()
+        if exc is not None and reply_tag is None:
+            self._fail(type(exc), exc, exc.__traceback__)
+        self._reply(reply_to, reply_tag,
+                None if exc is not None else future.result(), exc)
+
+    def _recover(self):
+        self._metrics.failures += 1
+        self._fail(*sys.exc_info())
+        try:
+            self.on_fail(*sys.exc_info())
+        except Exception:
+            self._fail(*sys.exc_info())
 
     def _handle(self, tag, mail):
         h = self._handlers.get(tag)
         if h:
+            if _handler_hook:
+                return _handler_hook(self, tag, h, mail)
             return h(mail)
 
     def _fail(self, exc_type, exc_value, traceback):
@@ -219,27 +1011,761 @@ class Actor(object):
     def __repr__(self):
         return '<Actor: %s>' % str(self)
 
+    # Actors are passed to other processes as references.
+    def __reduce__(self):
+        if self.id is None:
+            raise TypeError('Anonymous actor can not be pickled', self)
+        return (ActorRef, (self.id,))
+
 # Send a message using actor's id
-def send(to, tag, mail=None):
+# In worker processes of ProcessPool, messages to actors not hosted by the
+# worker are forwarded to the parent process.
+def send(to, tag, mail=None, priority=None):
     actor = Registry.get(to)
     if actor:
-        actor.send(tag, mail)
+        actor.send(tag, mail, priority)
+    elif _parent:
+        _parent.send(to, tag, [mail])
     else:
         logger.error('Actor not found %s:' % to)
 
+def send_many(to, tag, mails, priority=None):
+    actor = Registry.get(to)
+    if actor:
+        actor.send_many(tag, mails, priority)
+    elif _parent:
+        _parent.send(to, tag, list(mails))
+    else:
+        logger.error('Actor not found %s:' % to)
+
+# Pool of worker threads shared by actors (M:N scheduling).
+# An actor with pending messages is put on the run queue and a worker
+# processes at most `batch` messages of it before serving other actors.
+# Workers are started on demand and exit after _QUEUE_TIMEOUT of idleness.
+#
+# A handler blocking on a request to another pooled actor holds its worker
+# while waiting. If every worker is held and no batch completes within
+# `stall_timeout` sec. while actors are waiting to run, a worker is added
+# beyond `workers` (one per `stall_timeout`) and a warning is logged, so
+# that such handlers do not deadlock the pool.
+class Dispatcher(object):
+    def __init__(self, workers=None, batch=_DISPATCH_BATCH, stall_timeout=1.0):
+        self._workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self._batch = batch
+        self.stall_timeout = stall_timeout
+        self._runq = queue.Queue()
+        self._lock = threading.Lock()
+        self._nthreads = 0
+        self._completed = 0 # batches run so far
+        self._watchdog = False
+
+    def schedule(self, actor):
+        self._runq.put(actor)
+        with self._lock:
+            if self._nthreads >= self._workers:
+                if not self._watchdog:
+                    self._watchdog = True
+                    threading.Thread(target=self._watch, daemon=True).start()
+                return
+            self._nthreads += 1
+        threading.Thread(target=self._work).start()
+
+    def _work(self):
+        while True:
+            try:
+                actor = self._runq.get(block=True, timeout=_QUEUE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    if not self._runq.empty():
+                        continue
+                    self._nthreads -= 1
+                return
+            if actor._run_batch(self._batch):
+                self._runq.put(actor)
+            self._completed += 1
+
+    # runs while the pool is full
+    def _watch(self):
+        completed = self._completed
+        while True:
+            time.sleep(self.stall_timeout)
+            with self._lock:
+                if self._nthreads < self._workers:
+                    self._watchdog = False
+                    return
+                stalled = self._completed == completed and not self._runq.empty()
+                completed = self._completed
+                if stalled:
+                    self._nthreads += 1
+            if stalled:
+                logger.warning('All workers of the dispatcher are blocked; '
+                        'starting worker %d', self._nthreads)
+                threading.Thread(target=self._work).start()
+
 # Thread implementation
+# By default each activation of an actor runs on its own thread.
+# Set `dispatcher` (per class, per instance or globally with set_dispatcher)
+# to run actors on a shared pool of threads instead.
 class ThreadingActor(Actor):
-    def _create_mailbox(self, max_size=0):
-        return queue.Queue(max_size)
+    dispatcher = None
+
+    def _create_mailbox(self):
+        return Mailbox(self.mailbox_size, self.overflow, self.send_timeout,
+                self._start_actor)
 
     def _start_loop(self):
-        threading.Thread(target=self._main_loop).start()
+        if self.dispatcher:
+            self.dispatcher.schedule(self)
+        else:
+            threading.Thread(target=self._main_loop).start()
+
+_default_dispatcher = Dispatcher()
+
+# ThreadingActor which runs on the default dispatcher
+class PooledActor(ThreadingActor):
+    dispatcher = _default_dispatcher
+
+# Run all actors of `klass` (ThreadingActor by default) on `dispatcher`.
+# None restores thread-per-activation.
+def set_dispatcher(dispatcher, klass=None):
+    (klass or ThreadingActor).dispatcher = dispatcher
+
+# Asyncio implementation
+# All AsyncActors share one event loop running on a background thread.
+# Handlers and handle_batch may be coroutine functions. Messages are
+# processed one at a time per actor but handlers of different actors
+# interleave at `await`.
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, daemon=True).start()
+        return _event_loop
+
+class AsyncActor(Actor):
+    def _create_mailbox(self):
+        return Mailbox(self.mailbox_size, self.overflow, self.send_timeout,
+                self._start_actor)
+
+    def _start_loop(self):
+        asyncio.run_coroutine_threadsafe(self._async_loop(), get_event_loop())
+
+    async def _async_loop(self):
+        limit = max(self.batch_size, _DISPATCH_BATCH)
+        while True:
+            self._resume()
+            try:
+                mails = self._next_mails(limit, block=False)
+            except queue.Empty:
+                mails = []
+            await self._async_process_batch(mails)
+            if len(mails) == limit:
+                # give other actors a chance to run
+                await asyncio.sleep(0)
+                continue
+            if self._suspend():
+                return
+
+    # a short batch drained the mailbox, which is all a stop asks for
+    async def _async_process_batch(self, mails):
+        run = []
+        for tag, mail in mails:
+            if self._batchable(tag, mail):
+                run.append((tag, mail))
+                continue
+            await self._async_handle_run(run)
+            run = []
+            if tag != 'actor:stop':
+                await self._async_process(tag, mail)
+        await self._async_handle_run(run)
+
+    async def _async_handle_run(self, mails):
+        if not mails:
+            return
+        if type(self).handle_batch is Actor.handle_batch:
+            for tag, mail in mails:
+                await self._async_process(tag, mail)
+            return
+        start = time.perf_counter()
+        try:
+            result = self.handle_batch(mails)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            self._recover()
+        self._metrics.record('actor:batch', time.perf_counter() - start,
+                len(mails))
+
+    async def _async_process(self, tag, mail):
+        reply_to, reply_tag = self._reply_address(mail)
+        start = time.perf_counter()
+        try:
+            response = self._handle(tag, mail)
+            if inspect.isawaitable(response):
+                response = await response
+            self._reply(reply_to, reply_tag, response)
+        except Exception as e:
+            self._reply(reply_to, reply_tag, None, e)
+            self._recover()
+        self._metrics.record(tag, time.perf_counter() - start)
 
 # Process implementation
+# ProcessActors are hosted by a pool of long-lived worker processes.
+# The object created by the constructor is a proxy registered in the
+# Registry of the parent process. When __init__ returns, its attributes are
+# pickled and the actor is spawned on a worker, which then receives every
+# message sent to the proxy. Messages to other actors, replies and requests
+# made by the hosted actor are routed through the parent process.
+#
+# Messages and attributes must be picklable. Other actors are passed as
+# ActorRef and handlers must be methods of the actor or module level
+# functions. Each hosted actor runs on its own threads of the worker like a
+# ThreadingActor, so its handlers may block on requests to other actors,
+# including the ones hosted by the same worker.
+_parent = None # link to the parent process in workers of ProcessPool
+
+# Messages between processes are (kind, key, payload, tags, buffers).
+# The payload is pickled separately so that a message which can not be
+# unpickled by the receiver (e.g. of a class defined after the worker
+# started) does not break the reader: it is logged, the requests it carries
+# (reply `tags`) are answered with the error and its shared `buffers` are
+# freed.
+def _dumps(obj):
+    return bytes(ForkingPickler.dumps(obj))
+
+# reply tags of the requests among (tag, mail) pairs
+def _request_tags(mails):
+    return [mail['reply_tag'] for _, mail in mails
+            if isinstance(mail, dict) and 'reply_tag' in mail
+            and not mail.get('reply_to')]
+
+def _reply_message(tag, value, exc):
+    try:
+        payload = _dumps((value, exc))
+    except Exception as e:
+        payload = _dumps((None, RuntimeError('Can not pickle reply', repr(e))))
+    return ('reply', tag, payload, (tag,), ())
+
+# Answer the requests of a message which is not delivered with `exc` by
+# reply(tag, exc) and free its buffers.
+def _fail_message(msg, exc, reply):
+    _, _, _, tags, buffers = msg
+    _unlink_buffers(list(buffers))
+    for tag in tags:
+        reply(tag, exc)
+
+def _load(msg, reply):
+    try:
+        return ForkingPickler.loads(msg[2])
+    except Exception as e:
+        _fail_message(msg, RuntimeError('Can not unpickle %s' % msg[0],
+            repr(e)), reply)
+        raise
+# Zero-copy transfer of large buffers.
+# bytes, bytearray, memoryview and array.array values of mails (searched in
+# nested dicts, lists and tuples) larger than the threshold of the pool are
+# copied once into a shared memory segment and only a SharedBuffer handle is
+# pickled. The receiver gets a memoryview of the segment, which is valid
+# while the message is handled; copy it to keep the data.
+_BUFFER_TYPES = (bytes, bytearray, memoryview, array.array)
+
+class SharedBuffer(object):
+    __slots__ = ('name', 'nbytes', 'format', 'shape')
+
+    def __init__(self, view):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, view.nbytes))
+        shm.buf[:view.nbytes] = view.cast('B')
+        self.name = shm.name
+        self.nbytes = view.nbytes
+        self.format = view.format
+        self.shape = view.shape
+        shm.close()
+        # the receiver owns the segment
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+    def attach(self, segments):
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.unlink() # the memory is freed when the mapping is closed
+        view = shm.buf[:self.nbytes]
+        if self.format != 'B' or len(self.shape) != 1:
+            view = view.cast(self.format, self.shape)
+        segments.append((shm, view))
+        return view
+
+    # free a segment which is not going to be attached
+    def unlink(self):
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    def __getstate__(self):
+        return (self.name, self.nbytes, self.format, self.shape)
+
+    def __setstate__(self, state):
+        self.name, self.nbytes, self.format, self.shape = state
+
+def _export_buffers(obj, threshold, exported):
+    if isinstance(obj, SharedBuffer):
+        exported.append(obj)
+        return obj
+    if isinstance(obj, _BUFFER_TYPES):
+        view = memoryview(obj)
+        if view.nbytes < threshold or not view.c_contiguous:
+            return obj
+        buf = SharedBuffer(view)
+        exported.append(buf)
+        return buf
+    return _map_nested(obj, _export_buffers, threshold, exported)
+
+def _import_buffers(obj, segments):
+    if isinstance(obj, SharedBuffer):
+        return obj.attach(segments)
+    return _map_nested(obj, _import_buffers, segments)
+
+# Attach the buffers of `obj`. On failure the segments are freed, including
+# those which were not attached yet.
+def _import_or_unlink(obj, segments):
+    try:
+        return _import_buffers(obj, segments)
+    except Exception:
+        _release_buffers(segments)
+        _unlink_buffers(obj)
+        raise
+
+# Segments are owned by the receiver (see SharedBuffer), so the ones of
+# messages which are never delivered must be unlinked explicitly.
+def _unlink_buffers(obj):
+    if isinstance(obj, SharedBuffer):
+        obj.unlink()
+        return obj
+    return _map_nested(obj, _unlink_buffers)
+
+# apply func to the elements of dict, list and tuple. Copies only containers
+# which have changed elements.
+def _map_nested(obj, func, *args):
+    if isinstance(obj, dict):
+        new = None
+        for k, v in obj.items():
+            w = func(v, *args)
+            if w is not v:
+                if new is None:
+                    new = dict(obj)
+                new[k] = w
+        return obj if new is None else new
+    if type(obj) in (list, tuple):
+        items = [func(v, *args) for v in obj]
+        if any(w is not v for v, w in zip(obj, items)):
+            return type(obj)(items)
+    return obj
+
+def _release_buffers(segments):
+    for shm, view in segments:
+        try:
+            view.release()
+            shm.close()
+        except BufferError:
+            # views of the buffer still exist; closed when they are freed
+            pass
+
+class _ParentLink(object):
+    def __init__(self, index, outbox, shm_threshold):
+        self.index = index
+        self._outbox = outbox
+        self._shm_threshold = shm_threshold
+
+    def send(self, to, tag, mails):
+        kind = 'send'
+        buffers = []
+        if self._shm_threshold is not None:
+            mails = _export_buffers(mails, self._shm_threshold, buffers)
+            if buffers:
+                kind = 'shared_send'
+        try:
+            self._outbox.put((kind, to, _dumps((tag, mails)), (), buffers))
+        except Exception:
+            _unlink_buffers(buffers)
+            raise
+
+    def request(self, to, tag, mail, timeout):
+        future = Future(timeout)
+        try:
+            self._outbox.put(('request', self.index, _dumps((to, tag, mail)),
+                (future.tag,), ()))
+        except BaseException:
+            future._forget()
+            raise
+        return future
+
+    def reply(self, tag, value, exc):
+        self._outbox.put(_reply_message(tag, value, exc))
+
+    # answers a request of the parent which was not delivered
+    def fail(self, tag, exc):
+        self.reply(tag, None, exc)
+
+# Worker handle in the parent process
+class _Worker(object):
+    def __init__(self, ctx, index, outbox, shm_threshold):
+        self.inbox = ctx.SimpleQueue()
+        self.process = ctx.Process(target=_worker_main,
+                args=(index, self.inbox, outbox, shm_threshold), daemon=True)
+        self.process.start()
+        self.nactors = 0
+        self._shm_threshold = shm_threshold
 
-class ProcessActor(Actor):
-    def _create_mailbox(self, max_size=0):
-        return multiprocessing.Queue(max_size)
+    def send(self, key, mails):
+        kind = 'mail'
+        buffers = []
+        if self._shm_threshold is not None:
+            mails = _export_buffers(mails, self._shm_threshold, buffers)
+            if buffers:
+                kind = 'shared_mail'
+        try:
+            self.inbox.put((kind, key, _dumps(mails), _request_tags(mails),
+                buffers))
+        except Exception:
+            _unlink_buffers(buffers)
+            raise
+
+    def reply(self, tag, value, exc):
+        self.inbox.put(_reply_message(tag, value, exc))
+
+    # answers a request of the worker which was not delivered
+    def fail(self, tag, exc):
+        self.reply(tag, None, exc)
+
+# resolves a request of this process which was not delivered
+def _fail_future(tag, exc):
+    Future.resolve(tag, None, exc)
+
+def _worker_main(index, inbox, outbox, shm_threshold):
+    global _parent, _event_loop
+    # drop the state inherited from the parent by fork()
+    Registry._reset()
+    Future._pending = {}
+    Future._deadlines = _Deadlines()
+    _event_loop = None
+    _parent = _ParentLink(index, outbox, shm_threshold)
+
+    local = queue.SimpleQueue()
+    threading.Thread(target=_worker_reader, args=(inbox, local),
+            daemon=True).start()
+    actors = {}
+    while True:
+        msg = local.get()
+        if msg[0] == 'exit':
+            break
+        try:
+            _worker_handle(actors, msg)
+        except Exception:
+            logger.error('Failed to handle %s from the parent', msg[0],
+                    exc_info=sys.exc_info())
+    for actor in actors.values():
+        actor._actor_stop()
+
+def _worker_handle(actors, msg):
+    kind, key = msg[0], msg[1]
+    if kind == 'spawn':
+        klass, state = _load(msg, _parent.fail)
+        actor = klass.__new__(klass)
+        actor._host(state)
+        actors[key] = actor
+    elif kind == 'despawn':
+        actor = actors.pop(key, None)
+        if actor:
+            Registry.unregistor(actor)
+            actor._actor_stop()
+    else: # mail or shared_mail
+        actor = actors.get(key)
+        if actor is None:
+            _fail_message(msg, RuntimeError('Actor not hosted', key),
+                    _parent.fail)
+            return
+        mails = _load(msg, _parent.fail)
+        segments = []
+        if kind == 'shared_mail':
+            try:
+                mails = _import_or_unlink(mails, segments)
+            except Exception as e:
+                _fail_message(msg, e, _parent.fail)
+                raise
+        actor._deliver(mails, segments)
+
+# Replies are resolved on this thread, which never runs handlers.
+def _worker_reader(inbox, local):
+    while True:
+        try:
+            msg = inbox.get()
+        except (EOFError, OSError):
+            # the parent exited
+            local.put(('exit', None, None, (), ()))
+            break
+        if msg[0] == 'reply':
+            try:
+                value, exc = _load(msg, _fail_future)
+                Future.resolve(msg[1], value, exc)
+            except Exception:
+                logger.error('Failed to handle reply from the parent',
+                        exc_info=sys.exc_info())
+        else:
+            local.put(msg)
+            if msg[0] == 'exit':
+                break
+
+# shm_threshold: min size in bytes of buffers passed via shared memory.
+#                None disables shared memory transfer.
+class ProcessPool(object):
+    def __init__(self, workers=None, shm_threshold=_SHM_THRESHOLD):
+        self._max_workers = workers or os.cpu_count() or 1
+        self._shm_threshold = shm_threshold
+        self._ctx = multiprocessing.get_context()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._outbox = None
+
+    def spawn(self, actor, state, mails):
+        with self._lock:
+            if self._outbox is None:
+                self._outbox = self._ctx.SimpleQueue()
+                threading.Thread(target=self._pump, daemon=True).start()
+            if len(self._workers) < self._max_workers:
+                worker = _Worker(self._ctx, len(self._workers), self._outbox,
+                        self._shm_threshold)
+                self._workers.append(worker)
+            else:
+                worker = min(self._workers, key=lambda w: w.nactors)
+            worker.nactors += 1
+        worker.inbox.put(('spawn', actor._key, _dumps((type(actor), state)),
+            (), ()))
+        if mails:
+            worker.send(actor._key, mails)
+        return worker
+
+    # Remove the actor from its worker after it handled the messages sent
+    # before. Requests sent later fail.
+    def despawn(self, actor):
+        worker = actor._worker
+        with self._lock:
+            worker.nactors -= 1
+        worker.inbox.put(('despawn', actor._key, None, (), ()))
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.inbox.put(('exit', None, None, (), ()))
+        for worker in workers:
+            worker.process.join()
+            # free the buffers of mails sent after the worker exited
+            while not worker.inbox.empty():
+                _unlink_buffers(list(worker.inbox.get()[4]))
+
+    # handle messages from workers
+    def _pump(self):
+        while True:
+            msg = self._outbox.get()
+            kind, key = msg[0], msg[1]
+            try:
+                if kind == 'reply':
+                    value, exc = _load(msg, _fail_future)
+                    Future.resolve(key, value, exc)
+                elif kind == 'request':
+                    worker = self._workers[key]
+                    self._request(worker, *_load(msg, worker.fail),
+                            reply_tag=msg[3][0])
+                else: # send or shared_send
+                    tag, mails = _load(msg, _fail_future)
+                    if kind == 'shared_send':
+                        self._shared_send(key, tag, mails)
+                    else:
+                        send_many(key, tag, mails)
+            except Exception:
+                logger.error('Failed to route %s from worker', kind,
+                        exc_info=sys.exc_info())
+
+    # Pass the handles through to other workers. Otherwise attach the
+    # buffers and release them after the receiver handled the mails. The
+    # release is queued in the lane of the mails so that it is taken after
+    # them.
+    def _shared_send(self, to, tag, mails):
+        actor = Registry.get(to)
+        if isinstance(actor, ProcessActor):
+            actor.send_many(tag, mails)
+            return
+        segments = []
+        mails = _import_or_unlink(mails, segments)
+        if actor:
+            priority = actor._priority(tag, None)
+            try:
+                actor.send_many(tag, mails, priority)
+            finally:
+                actor.send('actor:release', {'segments': segments}, priority)
+        else:
+            logger.error('Actor not found %s:' % to)
+            _release_buffers(segments)
+
+    def _request(self, worker, to, tag, mail, reply_tag):
+        actor = Registry.get(to)
+        if actor is None:
+            worker.fail(reply_tag, RuntimeError('Actor not found', to))
+            return
+
+        def _done(future):
+            exc = future.exception()
+            value = None if exc else future.result()
+            worker.reply(reply_tag, value, exc)
+        actor.request(tag, mail).add_done_callback(_done)
+
+_default_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    global _default_process_pool
+    with _process_pool_lock:
+        if _default_process_pool is None:
+            _default_process_pool = ProcessPool()
+        return _default_process_pool
+
+class _ProcessActorType(type):
+    def __call__(cls, *args, **kwargs):
+        actor = super().__call__(*args, **kwargs)
+        actor._spawn()
+        return actor
+
+# attributes which are not sent to worker processes
+_PROXY_ATTRS = ('_mailbox', '_running', '_state_lock', '_resumed',
+        '_stopping', '_registered', '_topics', '_metrics', '_handlers',
+        '_worker', '_pending', '_last_metrics', '_metrics_future')
+
+class ProcessActor(Actor, metaclass=_ProcessActorType):
+    pool = None # ProcessPool; the default pool if None
+    _keys = itertools.count()
+
+    def __init__(self, id=None):
+        self._key = next(ProcessActor._keys)
+        self._worker = None
+        self._pending = []
+        self._last_metrics = None
+        self._metrics_future = None
+        super().__init__(id=id)
+
+    # only hosted actors have a mailbox
+    def _create_mailbox(self):
+        if _parent:
+            return Mailbox(self.mailbox_size, self.overflow,
+                    self.send_timeout, self._start_actor)
+        return None
 
     def _start_loop(self):
-        multiprocessing.Process(target=self._main_loop).start()
+        threading.Thread(target=self._main_loop).start()
+
+    def listen(self, tag, handler, coalesce=None):
+        if inspect.ismethod(handler) and handler.__self__ is self:
+            self.send('actor:listen', {'tag': tag, 'method': handler.__name__})
+        else:
+            super().listen(tag, handler)
+
+    # Messages are not coalesced in the worker.
+    def coalesce(self, tag, key):
+        pass
+
+    def _drained(self):
+        return self._mailbox is None or self._mailbox.empty()
+
+    # The proxy forwards the stop to the hosted actor.
+    def _actor_stop(self):
+        if _parent:
+            super()._actor_stop()
+        else:
+            self.send('actor:stop')
+
+    # Metrics are kept by the worker process. Returns the last snapshot
+    # received from the worker (None before the first one) without waiting
+    # and requests a fresh one. Give `timeout` to wait for the fresh one.
+    def metrics(self, timeout=None):
+        if _parent:
+            return super().metrics() # called by the hosted actor
+        future = self._metrics_future
+        if future is None or future.done():
+            future = self._metrics_future = self.request('actor:metrics',
+                    timeout=_QUEUE_TIMEOUT)
+            future.add_done_callback(self._metrics_received)
+        if timeout is not None:
+            future.get(timeout)
+        return self._last_metrics
+
+    def _metrics_received(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self._last_metrics = future.result()
+
+    # The proxy forwards messages to the worker in FIFO order, ignoring
+    # `priority`; the hosted actor applies priority_tags.
+    def send(self, tag, mail=None, priority=None):
+        if _parent:
+            super().send(tag, mail, priority)
+        else:
+            self.send_many(tag, [mail])
+
+    def send_many(self, tag, mails, priority=None):
+        if _parent:
+            super().send_many(tag, mails, priority)
+            return
+        mails = [(tag, mail) for mail in mails]
+        with self._state_lock:
+            if self._worker is None:
+                if self._pending is not None: # not despawned
+                    self._pending.extend(mails)
+                return
+        self._worker.send(self._key, mails)
+
+    def _spawn(self):
+        state = {k: v for k, v in self.__dict__.items()
+                if k not in _PROXY_ATTRS}
+        with self._state_lock:
+            pool = self.pool or get_process_pool()
+            self._worker = pool.spawn(self, state, self._pending)
+            self._pending = None
+
+    # Stop hosting the actor in the worker process, once it handled the
+    # messages sent before, and unregister the proxy. Messages sent later
+    # are ignored.
+    def despawn(self):
+        with self._state_lock:
+            if self._worker is None:
+                return
+            (self.pool or get_process_pool()).despawn(self)
+            self._worker = None
+        Registry.unregistor(self)
+
+    # Called in the worker process instead of __init__
+    def _host(self, state):
+        self.__dict__.update(state)
+        self._setup()
+        self._worker = None
+        self._pending = None
+        if self.id is not None:
+            Registry.registor(self)
+
+    # Queue mails forwarded by the proxy. Shared buffers are released after
+    # them, in the lowest lane they were queued in.
+    def _deliver(self, mails, segments):
+        for tag, run in itertools.groupby(mails, key=lambda m: m[0]):
+            if tag == 'actor:stop':
+                self._actor_stop()
+            else:
+                super().send_many(tag, [mail for _, mail in run])
+        if segments:
+            priority = min(self._priority(tag, None) for tag, _ in mails)
+            super().send('actor:release', {'segments': segments}, priority)
+
+    def _listen(self, mail):
+        if 'method' in mail:
+            mail = dict(mail, handler=getattr(self, mail['method']))
+        super()._listen(mail)
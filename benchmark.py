@@ -0,0 +1,288 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Micro benchmarks of carnival ==
+# Usage: python -m carnival.benchmark [--quick] [--only NAME ...]
+#                                     [--kinds KIND,...] [--output FILE]
+# Results are written as JSON (to stdout by default) so that they can be
+# compared across versions.
+
+import argparse
+import itertools
+import json
+import platform
+import re
+import statistics
+import sys
+import threading
+import time
+
+import carnival
+from carnival.actor import Registry
+
+_ids = itertools.count()
+
+def _new_id(prefix):
+    return 'bench:%s:%d' % (prefix, next(_ids))
+
+# Counts 'done' messages and wakes up the benchmark driver.
+class _Collector(carnival.ThreadingActor):
+    def __init__(self):
+        super().__init__(id=_new_id('collector'))
+        self._expected = 0
+        self._count = 0
+        self._event = threading.Event()
+        self.listen('done', self._done)
+
+    def expect(self, n):
+        self._count = 0
+        self._expected = n
+        self._event.clear()
+
+    def wait(self, timeout=60):
+        if not self._event.wait(timeout):
+            raise RuntimeError('benchmark timed out', self._count)
+
+    def _done(self, mail):
+        self._count += 1
+        if self._count >= self._expected:
+            self._event.set()
+
+# Handlers shared by the actors of every kind. Peers are addressed by id so
+# that the same code works across processes.
+class _Bench(object):
+    def __init__(self, id=None):
+        super().__init__(id=id)
+        self._received = 0
+        self.listen('echo', self._echo)
+        self.listen('ball', self._ball)
+        self.listen('count', self._count)
+        self.listen('hit', self._hit)
+
+    def _echo(self, mail):
+        return mail
+
+    def _ball(self, mail):
+        n = mail['n']
+        if n == 0:
+            carnival.send(mail['done'], 'done')
+        else:
+            carnival.send(mail['to'], 'ball', {'n': n - 1,
+                'to': mail['back'], 'back': mail['to'], 'done': mail['done']})
+
+    def _count(self, mail):
+        self._received += 1
+        if self._received == mail['total']:
+            self._received = 0
+            carnival.send(mail['done'], 'done')
+
+    def _hit(self, mail):
+        carnival.send(mail['done'], 'done')
+
+class ThreadingBench(_Bench, carnival.ThreadingActor):
+    pass
+
+class PooledBench(_Bench, carnival.PooledActor):
+    pass
+
+class AsyncBench(_Bench, carnival.AsyncActor):
+    pass
+
+class ProcessBench(_Bench, carnival.ProcessActor):
+    pass
+
+KINDS = {
+    'threading': ThreadingBench,
+    'pooled': PooledBench,
+    'async': AsyncBench,
+    'process': ProcessBench,
+    }
+
+def _latency(samples):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean_us': statistics.mean(samples) * 1e6,
+        'min_us': samples[0] * 1e6,
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p99_us': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+        }
+
+def _actor(kind):
+    return KINDS[kind](id=_new_id(kind))
+
+# Stop actors of a finished benchmark so that their threads and workers do
+# not pile up over the run.
+def _discard(*actors):
+    for actor in actors:
+        if isinstance(actor, carnival.ProcessActor):
+            actor.despawn()
+        else:
+            actor._actor_stop()
+            Registry.unregistor(actor)
+
+# round trips of a message between two actors
+def bench_pingpong(kind, collector, n):
+    a, b = _actor(kind), _actor(kind)
+    collector.expect(1)
+    start = time.perf_counter()
+    a.send('ball', {'n': 2 * n, 'to': b.id, 'back': a.id, 'done': collector.id})
+    collector.wait()
+    elapsed = time.perf_counter() - start
+    _discard(a, b)
+    return {'round_trips': n, 'round_trip_us': elapsed / n * 1e6}
+
+# messages per second from the driver to one actor
+def bench_throughput(kind, collector, n):
+    a = _actor(kind)
+    mail = {'total': n, 'done': collector.id}
+    a.request('echo').get(60) # warm up
+    collector.expect(1)
+    start = time.perf_counter()
+    for _ in range(n):
+        a.send('count', mail)
+    collector.wait()
+    elapsed = time.perf_counter() - start
+    _discard(a)
+    return {'messages': n, 'messages_per_sec': n / elapsed}
+
+# Actor.request().get() round trip
+def bench_request(kind, collector, n):
+    a = _actor(kind)
+    a.request('echo').get(60) # warm up
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        a.request('echo', {'i': i}).get(60)
+        samples.append(time.perf_counter() - start)
+    _discard(a)
+    return _latency(samples)
+
+# Registry.broadcast to 10, 1k and 10k actors of one class
+def bench_broadcast(kind, collector, n, sizes=(10, 1000, 10000)):
+    klass = KINDS[kind]
+    results = {}
+    for size in sizes:
+        actors = [_actor(kind) for _ in range(size)]
+        Registry.broadcast('echo', None, klass) # warm up
+        samples = []
+        for _ in range(max(1, n // size)):
+            collector.expect(size)
+            start = time.perf_counter()
+            Registry.broadcast('hit', {'done': collector.id}, klass)
+            collector.wait()
+            samples.append(time.perf_counter() - start)
+        _discard(*actors)
+        results[str(size)] = _latency(samples)
+    return results
+
+# latency of the first message after an actor is suspended
+def bench_activation(kind, collector, n):
+    a = _actor(kind)
+    samples = []
+    for _ in range(n):
+        a.request('echo').get(60)
+        a._actor_stop()
+        while a._running.is_set():
+            time.sleep(0.001)
+        start = time.perf_counter()
+        a.request('echo').get(60)
+        samples.append(time.perf_counter() - start)
+    _discard(a)
+    return _latency(samples)
+
+# Slack message unescaping: SlackFormatter against the regex used before it
+_LEGACY_UNESCAPE = re.compile(r"<(@(\w+)(\|[^>]+)?)|(#(\w+)(\|[^>]+)?)|(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)>")
+
+_UNESCAPE_TEXTS = {
+    'plain': 'deploy the latest build to staging when the tests pass',
+    'mention': '<@U024BE7LH> can you look at <#C024BE7LR> and ping <@U0G9QF9C6>?',
+    'entities': 'if a &lt; b &amp;&amp; b &gt; c then see <https://example.com/a?b=1&amp;c=2>',
+    }
+
+def bench_unescape(kind, collector, n):
+    from carnival.chat.formatter import SlackFormatter
+    users = {'U024BE7LH': 'alice', 'U0G9QF9C6': 'bob'}
+    channels = {'C024BE7LR': '#general'}
+
+    def legacy_unescape(m):
+        if m.group(2):
+            return '@' + users[m.group(2)]
+        elif m.group(5):
+            return '#' + channels[m.group(5)]
+        else:
+            return m.group(7)
+
+    def legacy(text):
+        return _LEGACY_UNESCAPE.sub(legacy_unescape, text).replace(
+                "&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+
+    formatter = SlackFormatter(users.__getitem__, channels.__getitem__)
+    results = {}
+    for name, text in _UNESCAPE_TEXTS.items():
+        result = {}
+        for impl, func in (('legacy', legacy), ('formatter', formatter.format)):
+            start = time.perf_counter()
+            for _ in range(n):
+                func(text)
+            result[impl + '_us'] = (time.perf_counter() - start) / n * 1e6
+        result['speedup'] = result['legacy_us'] / result['formatter_us']
+        results[name] = result
+    return results
+
+# name -> (function, iterations, actor kinds); benchmarks without kinds
+# (None) do not use actors.
+BENCHMARKS = {
+    'pingpong': (bench_pingpong, 10000, ('threading', 'pooled', 'async', 'process')),
+    'throughput': (bench_throughput, 100000, ('threading', 'pooled', 'async', 'process')),
+    'request': (bench_request, 5000, ('threading', 'pooled', 'async', 'process')),
+    'broadcast': (bench_broadcast, 20000, ('threading', 'pooled', 'async')),
+    'activation': (bench_activation, 200, ('threading', 'pooled', 'async')),
+    'unescape': (bench_unescape, 100000, None),
+    }
+
+def run(names=None, kinds=None, scale=1.0):
+    collector = _Collector()
+    results = {}
+    for name, (func, n, supported) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        if supported is None:
+            results[name] = func(None, collector, max(1, int(n * scale)))
+            continue
+        results[name] = {}
+        for kind in supported:
+            if kinds and kind not in kinds:
+                continue
+            results[name][kind] = func(kind, collector, max(1, int(n * scale)))
+    _discard(collector)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m carnival.benchmark')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS))
+    parser.add_argument('--kinds', type=lambda s: s.split(','),
+            help='comma separated subset of %s' % ','.join(KINDS))
+    parser.add_argument('--quick', action='store_true',
+            help='run 1/10 of the iterations')
+    parser.add_argument('--output', help='write JSON to this file')
+    args = parser.parse_args(argv)
+
+    report = run(args.only, args.kinds, 0.1 if args.quick else 1.0)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if 'process' in (args.kinds or KINDS):
+        carnival.get_process_pool().shutdown()
+
+if __name__ == '__main__':
+    main()
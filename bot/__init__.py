@@ -1 +1,2 @@
-from .bot import Bot
+from .bot import Bot, set_action_pool
+from .cache import ActionCache
@@ -2,63 +2,280 @@
 # Author: koichi
 
 import carnival
+from carnival.bot.cache import ActionCache
+from carnival.bot.matcher import Matcher
+from carnival.logging import logger
+import asyncio
+import collections
+import concurrent.futures
+import inspect
 import re
 import threading
 
 #== Chat bot using carnival module ==
 
+# Execution policies of actions:
+#   'inline'  run on the thread of the bot (actions are serialized)
+#   'thread'  run on a thread pool shared by all bots
+#   'process' run on a process pool shared by all bots. `action` must be
+#             picklable and receives a context which records posts and
+#             replies; they are sent by the bot when the action returns.
+#   'async'   coroutine functions run on the event loop shared with
+#             AsyncActors; other callables run on the default executor of
+#             the loop so that they do not block it.
+POLICIES = ('inline', 'thread', 'process', 'async')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(policy):
+    with _pools_lock:
+        pool = _pools.get(policy)
+        if pool is None:
+            if policy == 'thread':
+                pool = concurrent.futures.ThreadPoolExecutor(
+                        thread_name_prefix='carnival-bot')
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor()
+            _pools[policy] = pool
+        return pool
+
+# replace the pool of 'thread' or 'process' policy (e.g. to change its size)
+def set_action_pool(policy, pool):
+    if policy not in ('thread', 'process'):
+        raise ValueError('Unknown pool policy', policy)
+    with _pools_lock:
+        _pools[policy] = pool
+
+class _Rule(object):
+    def __init__(self, pattern, action, policy, max_inflight, cache, cache_channel):
+        self.pattern = pattern
+        self.action = action
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.cache = cache
+        self.cache_channel = cache_channel
+
 class Bot(carnival.ThreadingActor):
-    def __init__(self, chat, name, icon_url = None):
+    # Events of types other than `events`, from channels other than
+    # `channels` and, if `mention` is True, messages not mentioning this bot
+    # are not delivered to the bot (see Chat.add_bot). Bots handling only
+    # chat:message may pass events=('chat:message',); the default None
+    # delivers every event so that handlers listened by subclasses work.
+    # At most `max_inflight` actions (not None) run concurrently; the others
+    # wait until running ones finish.
+    # Results of actions heard with `cache` are kept in an LRU cache of
+    # `cache_size` entries.
+    def __init__(self, chat, name, icon_url = None,
+            events = None, channels = None, mention = False,
+            max_inflight = None, cache_size = 1024):
         super().__init__(id=name)
         self._chat = chat
         self.name = name
         self._icon_url = icon_url
-        self._actions = []
+        self._actions = Matcher()
+        self._max_inflight = max_inflight
+        self._inflight = 0
+        self._pending = collections.deque() # [(rule, ctx, text)]
+        self._cache = ActionCache(cache_size)
 
         self.listen('add_action', self._add_action)
+        self.listen('bot:done', self._done)
+        self.listen('bot:invalidate', self._invalidate)
         self.listen('chat:message', self._on_message)
 
         # Join this bot to the chat
-        chat.add_bot(self)
+        chat.add_bot(self, events=events, channels=channels, mention=mention)
 
     # post `text` to user `to` (if given) in `channel`
     def post(self, channel, text, to=None, **kwargs):
         self._chat.post(channel, self.name, text, to=to, icon_url=self._icon_url, **kwargs)
-    
-    # call `action` when `pattern` matches with received messages
-    def hear(self, pattern, action, flag=0):
+
+    # call `action` when `pattern` matches with received messages.
+    # `action` runs according to `policy` (see POLICIES) and, if
+    # `max_inflight` is given, at most that many calls of it run concurrently.
+    # If `cache` is given, the posts and replies of `action` are cached for
+    # `cache` sec. per matched groups (and channel if `cache_channel`) and
+    # sent again without calling `action` while cached.
+    def hear(self, pattern, action, flag=0, policy='inline', max_inflight=None,
+            cache=None, cache_channel=False):
+        if policy not in POLICIES:
+            raise ValueError('Unknown execution policy', policy)
         self.send('add_action', {
             'pattern': pattern,
             'action': action,
-            'flag': flag
+            'flag': flag,
+            'policy': policy,
+            'max_inflight': max_inflight,
+            'cache': cache,
+            'cache_channel': cache_channel,
             })
 
+    # drop cached results of the action heard with `pattern`, or of all
+    # actions if `pattern` is None
+    def invalidate(self, pattern=None):
+        self.send('bot:invalidate', {'pattern': pattern})
+
+    def cache_stats(self):
+        return self._cache.stats()
+
     def _add_action(self, mail):
         pat = re.compile(mail['pattern'], mail['flag'])
-        self._actions.append((pat, mail['action']))
+        rule = _Rule(mail['pattern'], mail['action'], mail.get('policy', 'inline'),
+                mail.get('max_inflight'), mail.get('cache'),
+                mail.get('cache_channel', False))
+        self._actions.add(pat, rule)
+
+    def _invalidate(self, mail):
+        pattern = mail.get('pattern')
+        if pattern is None:
+            self._cache.invalidate()
+            return
+        for rule in self._actions.values():
+            if rule.pattern == pattern:
+                self._cache.invalidate(rule)
 
     def _on_message(self, mail):
-        for p, h in self._actions:
-            m = p.search(mail['text'])
-            if m:
-                ctx = ChatContext(self, m, mail)
-                h(ctx, mail['text'])
+        for rule, m in self._actions.search(mail['text']):
+            ctx = ChatContext(self, m, mail)
+            if rule.cache is not None:
+                key = (rule, m.group(0)) + m.groups()
+                if rule.cache_channel:
+                    key += (mail.get('channel'),)
+                posts = self._cache.get(key)
+                if posts is not None:
+                    ctx._replay(posts)
+                    continue
+                ctx._key = key
+                ctx._posts = []
+            if rule.policy == 'inline':
+                rule.action(ctx, mail['text'])
+                self._store(rule, ctx, ctx._posts)
+            elif self._runnable(rule):
+                self._start(rule, ctx, mail['text'])
+            else:
+                self._pending.append((rule, ctx, mail['text']))
+
+    def _runnable(self, rule):
+        return ((self._max_inflight is None or self._inflight < self._max_inflight)
+            and (rule.max_inflight is None or rule.inflight < rule.max_inflight))
+
+    def _start(self, rule, ctx, text):
+        self._inflight += 1
+        rule.inflight += 1
+        try:
+            if rule.policy == 'thread':
+                future = _pool('thread').submit(rule.action, ctx, text)
+            elif rule.policy == 'process':
+                future = _pool('process').submit(_run_recorded,
+                        rule.action, _RecordingContext(ctx), text)
+            else:
+                future = asyncio.run_coroutine_threadsafe(
+                        _run_async(rule.action, ctx, text),
+                        carnival.get_event_loop())
+        except Exception:
+            self._inflight -= 1
+            rule.inflight -= 1
+            raise
+        future.add_done_callback(lambda f: self.send('bot:done', {
+            'rule': rule,
+            'ctx': ctx,
+            'future': f,
+            }))
+
+    # an action started by _start finished
+    def _done(self, mail):
+        rule = mail['rule']
+        self._inflight -= 1
+        rule.inflight -= 1
+        future = mail['future']
+        if future.cancelled():
+            pass
+        elif future.exception() is not None:
+            exc = future.exception()
+            logger.error('Action of %s failed: %r', self.name, exc,
+                    exc_info=(type(exc), exc, exc.__traceback__))
+        elif rule.policy == 'process':
+            mail['ctx']._replay(future.result())
+            self._store(rule, mail['ctx'], future.result())
+        else:
+            self._store(rule, mail['ctx'], mail['ctx']._posts)
+
+        # start waiting actions in order, skipping those of rules at the limit
+        waiting, self._pending = self._pending, collections.deque()
+        for rule, ctx, text in waiting:
+            if self._runnable(rule):
+                self._start(rule, ctx, text)
+            else:
+                self._pending.append((rule, ctx, text))
+
+    def _store(self, rule, ctx, posts):
+        if rule.cache is not None and ctx._key is not None:
+            self._cache.put(ctx._key, list(posts), rule.cache)
 
 class ChatContext(object):
     def __init__(self, bot, match, mail):
         self._bot   = bot
         self._match = match
         self._mail  = mail
+        self._key   = None # cache key of the action
+        self._posts = None # [(reply, text, to, kwargs)] recorded for the cache
 
     def post(self, text, to=None, **kwargs):
+        if self._posts is not None:
+            self._posts.append((False, text, to, kwargs))
+        self._post(text, to, kwargs)
+
+    def reply(self, text, **kwargs):
+        if self._posts is not None:
+            self._posts.append((True, text, None, kwargs))
+        self._post(text, self._mail['user'], kwargs)
+
+    def _post(self, text, to, kwargs):
         text = self._match.expand(text)
         self._bot.post(self._mail['channel'], text, to=to, **kwargs)
 
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._match.group(key)
+        else:
+            return self._mail[key]
+
+    # send recorded posts; replies go to the user of this message
+    def _replay(self, posts):
+        for reply, text, to, kwargs in posts:
+            self._post(text, self._mail['user'] if reply else to, kwargs)
+
+# Picklable stand-in of ChatContext for the 'process' policy. Posts are
+# recorded and sent by the bot after the action returns.
+class _RecordingContext(object):
+    def __init__(self, ctx):
+        self._groups = (ctx._match.group(0),) + ctx._match.groups()
+        self._mail   = ctx._mail
+        self._posts  = []
+
+    def post(self, text, to=None, **kwargs):
+        self._posts.append((False, text, to, kwargs))
+
     def reply(self, text, **kwargs):
-        self.post(text, to=self._mail['user'], **kwargs)
+        self._posts.append((True, text, None, kwargs))
 
     def __getitem__(self, key):
         if isinstance(key, int):
-            return self._match.group(key)
+            return self._groups[key]
         else:
             return self._mail[key]
+
+def _run_recorded(action, ctx, text):
+    action(ctx, text)
+    return ctx._posts
+
+async def _run_async(action, ctx, text):
+    if inspect.iscoroutinefunction(action):
+        return await action(ctx, text)
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, action, ctx, text)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
@@ -0,0 +1,58 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Result cache of bot actions ==
+# LRU cache of at most `maxsize` entries, each of which expires after the
+# TTL given when it is stored. Keys are tuples whose first element is the
+# owner (a rule of a bot), so that the entries of an owner can be
+# invalidated together. Not thread-safe; a Bot uses it on its own thread.
+
+import collections
+import time
+
+class ActionCache(object):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict() # key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # cached value of `key` or None
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # drop the entries of `owner`, or all entries if `owner` is None
+    def invalidate(self, owner=None):
+        if owner is None:
+            self._entries.clear()
+        else:
+            for key in [k for k in self._entries if k[0] is owner]:
+                del self._entries[key]
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
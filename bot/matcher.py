@@ -0,0 +1,165 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Multi-pattern matching of Bot.hear rules ==
+# Matcher finds the rules whose regexes match a text without running every
+# regex. A literal string which any match of the regex must contain is
+# extracted from each rule (one of several for alternations) and all of
+# them are searched at once with an Aho-Corasick automaton over the
+# folded text (see _fold). Only the rules whose literal is found and the rules
+# without extractable literals run their regexes, in the order they were
+# added.
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+import re
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+        getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
+
+# Under IGNORECASE 'i' also matches dotted capital and dotless small I,
+# which casefold() does not map to 'i' (the other ASCII letters agree with
+# casefold()). Literals and texts are folded with these mapped to 'i'.
+_DOTTED_DOTLESS = {0x130: 'i', 0x131: 'i'}
+
+def _fold(text):
+    if '\u0130' in text or '\u0131' in text:
+        text = text.translate(_DOTTED_DOTLESS)
+    return text.casefold()
+
+# The better of two requirements; longer shortest literals and then fewer
+# alternatives filter more.
+def _better(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    ka = (min(map(len, a)), -len(a))
+    kb = (min(map(len, b)), -len(b))
+    return a if ka >= kb else b
+
+# A set of literals one of which appears in any text matching `seq`
+# (folded), or None if there is no such set.
+def _required(seq, icase):
+    best = None
+    run = []
+    for op, av in seq:
+        # non-ASCII characters may match differently under IGNORECASE
+        # and casefold()
+        if op is sre_constants.LITERAL and (not icase or av < 128):
+            run.append(chr(av))
+            continue
+        if run:
+            best = _better(best, frozenset([_fold(''.join(run))]))
+            run = []
+        req = None
+        if op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            sub = icase
+            if add_flags & re.IGNORECASE:
+                sub = True
+            if del_flags & re.IGNORECASE:
+                sub = False
+            req = _required(p, sub)
+        elif op in _REPEATS and av[0] >= 1:
+            req = _required(av[2], icase)
+        elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            req = _required(av, icase)
+        elif op is sre_constants.BRANCH:
+            alts = [_required(b, icase) for b in av[1]]
+            if all(alts):
+                req = frozenset().union(*alts)
+        best = _better(best, req)
+    if run:
+        best = _better(best, frozenset([_fold(''.join(run))]))
+    return best
+
+def required_literals(pattern):
+    if isinstance(pattern.pattern, bytes) or pattern.flags & re.LOCALE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    return _required(parsed, bool(pattern.flags & re.IGNORECASE))
+
+class Matcher(object):
+    def __init__(self):
+        self._rules = []     # [(pattern, value)]
+        self._always = []    # indices of rules without literals
+        self._goto = [{}]    # state -> {char: state}
+        self._out = [set()]  # state -> indices of rules whose literals end here
+        self._fail = None    # state -> failure state; None when outdated
+        self._outputs = None # state -> indices of rules (following failures)
+
+    def __len__(self):
+        return len(self._rules)
+
+    # values of the rules in the order they were added
+    def values(self):
+        return [value for pattern, value in self._rules]
+
+    # add a rule; patterns are tried in the order they are added
+    def add(self, pattern, value):
+        index = len(self._rules)
+        self._rules.append((pattern, value))
+        literals = required_literals(pattern)
+        if not literals:
+            self._always.append(index)
+            return
+        for literal in literals:
+            state = 0
+            for c in literal:
+                nxt = self._goto[state].get(c)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._out.append(set())
+                    self._goto[state][c] = nxt
+                state = nxt
+            self._out[state].add(index)
+        self._fail = None
+
+    def _build(self):
+        goto = self._goto
+        fail = [0] * len(goto)
+        outputs = [frozenset(o) for o in self._out]
+        queue = list(goto[0].values())
+        for state in queue:
+            for c, nxt in goto[state].items():
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[nxt] = f if f != nxt else 0
+                outputs[nxt] = outputs[nxt] | outputs[fail[nxt]]
+                queue.append(nxt)
+        self._outputs = outputs
+        self._fail = fail
+
+    # indices of rules which may match `text`, in the order of rules
+    def candidates(self, text):
+        if self._fail is None:
+            self._build()
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        found = set(self._always)
+        state = 0
+        for c in _fold(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return sorted(found)
+
+    # (value, match object) of each rule matching `text`, in the order of rules
+    def search(self, text):
+        for index in self.candidates(text):
+            pattern, value = self._rules[index]
+            m = pattern.search(text)
+            if m:
+                yield value, m
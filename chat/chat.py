@@ -2,11 +2,18 @@
 # Author: koichi
 
 import carnival
+import re
 
 class Chat(carnival.ThreadingActor):
+    # event type -> key function of state update events. Undelivered events
+    # with the same key (not None) are replaced by the latest one.
+    coalesce_events = {}
+
     def __init__(self, id=None):
         super().__init__(id=id)
         self._bots = []
+        self._routes = {} # (tag, channel) -> [(bot, mention pattern)]
+        self.coalesce('chat:deliver', self._deliver_key)
 
         self.listen('chat:post', self._post)
         self.listen('chat:channel_list', self._channel_list)
@@ -15,8 +22,18 @@ class Chat(carnival.ThreadingActor):
         self.listen('chat:remove_bot', self._remove_bot)
         self.listen('chat:deliver', self._deliver)
 
-    def add_bot(self, bot):
-        self.send('chat:add_bot', {'bot': bot})
+    # Deliver events to `bot`. Only events whose tag is in `events`, which
+    # are sent in one of `channels` (as in mail['channel']) and, if `mention`
+    # is True, messages mentioning '@' + bot.name are delivered.
+    # None means every event type or every channel. Events without a channel
+    # pass the channel filter and events without a text pass the mention filter.
+    def add_bot(self, bot, events=None, channels=None, mention=False):
+        self.send('chat:add_bot', {
+            'bot': bot,
+            'events': events,
+            'channels': channels,
+            'mention': mention,
+            })
 
     def remove_bot(self, bot):
         self.send('chat:remove_bot', {'bot': bot})
@@ -39,18 +56,59 @@ class Chat(carnival.ThreadingActor):
         raise NotImplementedError('chat:user_list')
 
     def _add_bot(self, mail):
-        self._bots.append(mail['bot'])
+        self._remove_bot(mail)
+        events = mail.get('events')
+        channels = mail.get('channels')
+        mention = None
+        if mail.get('mention'):
+            mention = re.compile(r'@%s(?!\w)' % re.escape(mail['bot'].name))
+        self._bots.append((
+            mail['bot'],
+            None if events is None else frozenset(events),
+            None if channels is None else frozenset(channels),
+            mention))
+        self._routes = {}
 
     def _remove_bot(self, mail):
-        if mail['bot'] in self._bots:
-            self._bots.remove(mail['bot'])
+        bots = [b for b in self._bots if b[0] is not mail['bot']]
+        if len(bots) != len(self._bots):
+            self._bots = bots
+            self._routes = {}
+
+    # bots interested in events of `tag` in `channel`
+    def _route(self, tag, channel):
+        route = self._routes.get((tag, channel))
+        if route is None:
+            route = [(bot, mention)
+                    for bot, events, channels, mention in self._bots
+                    if (events is None or tag in events)
+                    and (channels is None or channel is None or channel in channels)]
+            self._routes[(tag, channel)] = route
+        return route
+
+    # True if any bot may receive events of `tag`
+    def _subscribed(self, tag):
+        return bool(self._route(tag, None))
 
     # deliver messages to bots
     def _deliver(self, mail):
         tag  = mail['tag']
         mail = mail['mail']
-        for bot in self._bots:
+        channel = mail.get('channel')
+        if not isinstance(channel, str):
+            channel = None
+        text = mail.get('text')
+        for bot, mention in self._route(tag, channel):
+            if mention and isinstance(text, str) and not mention.search(text):
+                continue
             bot.send(tag, mail)
 
     def deliver(self, tag, mail):
         self.send('chat:deliver', {'tag': tag, 'mail': mail})
+
+    def _deliver_key(self, mail):
+        key = self.coalesce_events.get(mail['tag'])
+        if key:
+            k = key(mail['mail'])
+            if k is not None:
+                return (mail['tag'], k)
@@ -0,0 +1,95 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Slack message formatting ==
+# SlackFormatter converts Slack's formatted texts to readable texts.
+# See https://api.slack.com/docs/formatting
+#
+#   <@U123>, <@U123|name>    '@' + name of the user
+#   <#C123>, <#C123|name>    '#' + name of the channel
+#   <!here>, <!channel> ...  '@here', '@channel' ...
+#   <!...|label>             label
+#   <http://...>, <url|...>  the url
+#   &amp; &lt; &gt;          & < >
+#
+# Texts without '<' and '&' are returned as is and texts without '<' only
+# have their entities replaced. Display names of users and channels are
+# cached (at most `cache_size` of them, oldest first out) until invalidated.
+
+import re
+
+_TOKEN = re.compile(r'<([@#!]?)([^<>|]*)(?:\|([^<>]*))?>|&(amp|lt|gt);')
+_ENTITY = re.compile(r'&(amp|lt|gt);')
+_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>'}
+
+def _entity(m):
+    return _ENTITIES[m.group(1)]
+
+class SlackFormatter(object):
+    # `user_name(id)` and `channel_name(id)` return the display names
+    # ('#' + name for channels) of ids which are not cached.
+    def __init__(self, user_name, channel_name, cache_size=4096):
+        self._user_name = user_name
+        self._channel_name = channel_name
+        self.cache_size = cache_size
+        self._names = {} # id -> display name
+
+    def _cache(self, id, name):
+        self._names[id] = name
+        if len(self._names) > self.cache_size:
+            del self._names[next(iter(self._names))]
+        return name
+
+    def user(self, id):
+        name = self._names.get(id)
+        if name is None:
+            name = self._cache(id, '@' + self._user_name(id))
+        return name[1:]
+
+    def channel(self, id):
+        if id[:1] not in ('C', 'G'):
+            return id
+        name = self._names.get(id)
+        if name is None:
+            name = self._cache(id, self._channel_name(id))
+        return name
+
+    # forget the cached name of user or channel `id`, or all names
+    def invalidate(self, id=None):
+        if id is None:
+            self._names.clear()
+        else:
+            self._names.pop(id, None)
+
+    def _token(self, m):
+        sigil, body, label, entity = m.groups()
+        if entity:
+            return _ENTITIES[entity]
+        if sigil == '@':
+            name = self._names.get(body)
+            if name is None:
+                try:
+                    name = '@' + self.user(body)
+                except Exception:
+                    return '@' + (label or body)
+            return name
+        elif sigil == '#':
+            try:
+                return self.channel(body)
+            except Exception:
+                return '#' + (label or body)
+        elif sigil == '!':
+            text = label or '@' + body
+        else:
+            text = body
+        if '&' in text:
+            text = _ENTITY.sub(_entity, text)
+        return text
+
+    def format(self, text):
+        if '<' not in text:
+            if '&' not in text:
+                return text
+            # &amp; last so that '&amp;lt;' becomes '&lt;'
+            return text.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+        return _TOKEN.sub(self._token, text)
@@ -15,9 +15,9 @@ class Shell(Chat):
         thread.start()
 
     # Override
-    def add_bot(self, bot):
+    def add_bot(self, bot, **kwargs):
         self.display('>> %s is joined' % bot.name)
-        super().add_bot(bot)
+        super().add_bot(bot, **kwargs)
 
     # Override
     def remove_bot(self, bot):
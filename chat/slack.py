@@ -3,10 +3,30 @@
 
 from carnival import ThreadingActor, WebSocket, Scheduler
 from carnival.chat import Chat
+from carnival.chat.formatter import SlackFormatter
+from carnival.chat.workspace import Workspace
 from carnival.logging import logger
 import slacker
+import requests
+import requests.adapters
+import collections
+import concurrent.futures
 import json
 import re
+import sys
+import threading
+import time
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# "type" of a RTM frame
+_FRAME_TYPE = re.compile(r'"type"\s*:\s*"([^"\\]*)"')
+# users and channels referred to in a message text
+_REFERENCE = re.compile(r'<([@#])([^<>|]*)')
 
 # Wrapper of slacker
 SLACK_API_METHODS = [
@@ -22,7 +42,7 @@ SLACK_API_METHODS = [
     "groups.leave", "groups.list", "groups.mark", "groups.open",
     "groups.rename", "groups.set_purpose", "groups.set_topic",
     "groups.unarchive", "im.close", "im.history", "im.list", "im.mark",
-    "im.open", "oauth.access", "rtm.start", "search.all", "search.files",
+    "im.open", "oauth.access", "rtm.connect", "rtm.start", "search.all", "search.files",
     "search.messages", "stars.list", "team.access_logs", "team.info",
     "users.get_presence", "users.info", "users.list", "users.set_active",
     "users.set_presence"]
@@ -45,11 +65,43 @@ RTM_EVENT_TYPES = [
     "bot_changed", "accounts_changed", "team_migration_started",
     ]
 
+SLACK_API_URL = 'https://slack.com/api/'
+
+# requests.Session sending Slack API calls to `base_url` instead of Slack
+# (e.g. a local fake server for tests).
+class _Session(requests.Session):
+    def __init__(self, base_url=None):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        if self.base_url and url.startswith(SLACK_API_URL):
+            url = self.base_url + url[len(SLACK_API_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+# Web API calls run on a pool of `max_inflight` threads sharing at most
+# `max_connections` keep-alive connections; replies of request() resolve
+# as each call completes.
+# Calls of ORDERED_METHODS to one channel run one at a time in the order
+# they were received so that messages are not reordered; calls to
+# different channels still run in parallel.
 class SlackAPI(ThreadingActor):
-    def __init__(self, token):
+    ORDERED_METHODS = ('chat.post_message', 'chat.update', 'chat.delete')
+
+    def __init__(self, token, max_inflight=4, max_connections=4,
+            base_url=None, timeout=slacker.DEFAULT_TIMEOUT):
         super().__init__()
+        self._channels = {} # channel -> deque of ordered calls waiting
 
-        s = slacker.Slacker(token)
+        session = _Session(base_url)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=max_connections, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_inflight,
+                thread_name_prefix='SlackAPI')
+
+        s = slacker.Slacker(token, timeout=timeout, session=session)
         for method in SLACK_API_METHODS:
             cat, meth = method.split('.')
             func = getattr(getattr(s, cat), meth)
@@ -57,30 +109,252 @@ class SlackAPI(ThreadingActor):
             # call a method to create a scope for `func`
             self._add_method(method, func)
 
+        self.listen('api:done', self._done)
+
     def _add_method(self, method, func):
-        def _callback(mail):
+        def _call(mail):
             return func(**mail).body
+        ordered = method in self.ORDERED_METHODS
+        def _callback(mail):
+            mail = mail or {}
+            if ordered and mail.get('channel') is not None:
+                return self._ordered(mail['channel'], _call, mail)
+            return self._executor.submit(_call, mail)
         self.listen(method, _callback)
 
+    def _ordered(self, channel, call, mail):
+        future = concurrent.futures.Future()
+        waiting = self._channels.get(channel)
+        if waiting is None:
+            self._channels[channel] = collections.deque()
+            self._submit(channel, call, mail, future)
+        else:
+            waiting.append((call, mail, future))
+        return future
+
+    def _submit(self, channel, call, mail, future):
+        def _finish(f):
+            exc = f.exception()
+            if exc is None:
+                future.set_result(f.result())
+            else:
+                future.set_exception(exc)
+            self.send('api:done', {'channel': channel})
+        self._executor.submit(call, mail).add_done_callback(_finish)
+
+    # an ordered call finished; start the next one of the channel
+    def _done(self, mail):
+        channel = mail['channel']
+        waiting = self._channels[channel]
+        if waiting:
+            self._submit(channel, *waiting.popleft())
+        else:
+            del self._channels[channel]
+
+# Outbound queue of chat.post_message calls.
+# Each channel has a token bucket of `burst` posts refilled at `rate` posts
+# per sec. and at most one post in flight; the next post of the channel is
+# sent when the previous one is answered, so posts keep their order. Posts
+# wait in the queue of the channel, where consecutive short posts (at most
+# `merge_size` characters together) with the same parameters are merged
+# into one message if `merge` is True.
+# When Slack answers HTTP 429, the post is requeued and every channel
+# pauses for Retry-After sec.
+class SlackOutbox(ThreadingActor):
+    def __init__(self, api, rate=1.0, burst=3, merge=True, merge_size=1000):
+        super().__init__()
+        self._api = api
+        self.rate = rate
+        self.burst = burst
+        self.merge = merge
+        self.merge_size = merge_size
+        # channel -> [tokens, last refill, deque of [params, enqueued], in flight]
+        self._channels = {}
+        self._paused_until = 0
+        self._timer = None
+        self._wake_at = None
+        self._stats = {
+            'sent': 0,
+            'merged': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'delay_total': 0.0,
+            'delay_max': 0.0,
+            }
+
+        self.listen('outbox:post', self._post)
+        self.listen('outbox:wake', self._wake)
+        self.listen('outbox:sent', self._sent)
+        self.listen('outbox:stats', self._get_stats)
+
+    def post(self, params):
+        self.send('outbox:post', params)
+
+    # queue depth and delay (sec. between queueing and sending) of posts
+    def stats(self, timeout=None):
+        return self.request('outbox:stats').get(timeout)
+
+    def _get_stats(self, mail):
+        stats = dict(self._stats)
+        stats['delay_avg'] = stats['delay_total'] / max(1, stats['sent'])
+        stats['queued'] = {ch: len(c[2]) for ch, c in self._channels.items() if c[2]}
+        stats['depth'] = sum(stats['queued'].values())
+        stats['paused'] = max(0, self._paused_until - time.monotonic())
+        return stats
+
+    def _channel(self, channel):
+        c = self._channels.get(channel)
+        if c is None:
+            c = [self.burst, time.monotonic(), collections.deque(), False]
+            self._channels[channel] = c
+        return c
+
+    def _mergeable(self, a, b):
+        if not self.merge or a.get('attachments') or b.get('attachments'):
+            return False
+        if len(a['text']) + len(b['text']) + 1 > self.merge_size:
+            return False
+        return all(a.get(k) == b.get(k) for k in set(a) | set(b) if k != 'text')
+
+    def _post(self, mail):
+        queue = self._channel(mail['channel'])[2]
+        if queue and self._mergeable(queue[-1][0], mail):
+            queue[-1][0] = dict(queue[-1][0], text=queue[-1][0]['text'] + '\n' + mail['text'])
+            self._stats['merged'] += 1
+        else:
+            queue.append([mail, time.monotonic()])
+        self._pump()
+
+    def _wake(self, mail):
+        self._wake_at = None
+        self._pump()
+
+    # send queued posts which have tokens and schedule a wakeup for the rest
+    def _pump(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._schedule(self._paused_until - now)
+            return
+        wait = None
+        for channel, c in self._channels.items():
+            tokens, last, queue, inflight = c
+            c[0] = tokens = min(self.burst, tokens + (now - last) * self.rate)
+            c[1] = now
+            if inflight or not queue:
+                continue
+            if tokens >= 1:
+                params, enqueued = queue.popleft()
+                c[0] = tokens - 1
+                c[3] = True
+                self._send(params, enqueued, now)
+            else:
+                w = (1 - tokens) / self.rate
+                wait = w if wait is None else min(wait, w)
+        if wait is not None:
+            self._schedule(wait)
+
+    def _send(self, params, enqueued, now):
+        delay = now - enqueued
+        self._stats['sent'] += 1
+        self._stats['delay_total'] += delay
+        self._stats['delay_max'] = max(self._stats['delay_max'], delay)
+        future = self._api.request('chat.post_message', params)
+        future.add_done_callback(lambda f: self.send('outbox:sent', {
+            'params': params,
+            'enqueued': enqueued,
+            'future': f,
+            }))
+
+    def _sent(self, mail):
+        c = self._channel(mail['params']['channel'])
+        c[3] = False
+        exc = mail['future'].exception()
+        if exc is not None:
+            retry_after = self._retry_after(exc)
+            if retry_after is None:
+                self._stats['failed'] += 1
+                logger.error('Failed to post to %s: %r', mail['params']['channel'], exc)
+            else:
+                logger.warning('Rate limited by Slack; retrying after %.1f sec', retry_after)
+                self._stats['rate_limited'] += 1
+                self._stats['sent'] -= 1
+                self._paused_until = max(self._paused_until,
+                        time.monotonic() + retry_after)
+                c[2].appendleft([mail['params'], mail['enqueued']])
+        self._pump()
+
+    # wait in sec. requested by a rate limit error, None for other errors
+    def _retry_after(self, exc):
+        response = getattr(exc, 'response', None)
+        if response is not None and response.status_code == 429:
+            return float(response.headers.get('Retry-After', slacker.DEFAULT_WAIT))
+        if isinstance(exc, slacker.Error) and str(exc) == 'ratelimited':
+            return float(slacker.DEFAULT_WAIT)
+        return None
+
+    def _schedule(self, delay):
+        wake_at = time.monotonic() + delay
+        if self._wake_at is not None and self._wake_at <= wake_at:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._wake_at = wake_at
+        self._timer = threading.Timer(delay, self.send, ('outbox:wake',))
+        self._timer.daemon = True
+        self._timer.start()
+
 # wait times in sec. for reconnecting to slack
 # when some error happens.
 SLACK_RESTART_WAITTIMES = [0, 1, 10, 60, 300, 600]
 class Slack(Chat):
-    def __init__(self, token, scheduler=None, id='Slack'):
-        self._api = SlackAPI(token)
-        self._env = None
+    # pure state updates; only the latest one per key is delivered to bots
+    coalesce_events = {
+        'presence_change': lambda mail: mail.get('user'),
+        'manual_presence_change': lambda mail: 'self',
+        'user_typing': lambda mail: (mail.get('channel'), mail.get('user')),
+        'channel_marked': lambda mail: mail.get('channel'),
+        'im_marked': lambda mail: mail.get('channel'),
+        'group_marked': lambda mail: mail.get('channel'),
+        'pref_change': lambda mail: mail.get('name'),
+        }
+
+    # `api` is a SlackAPI to use instead of a default one (e.g. with a
+    # different base_url or pool size)
+    # `outbox` is a SlackOutbox to queue posts in instead of a default one
+    # `cache_path` is a file to keep the workspace state in across restarts
+    # (see Workspace). With a cached state, reconnects use rtm.connect and
+    # users and channels are fetched when referenced.
+    # `json_loads` decodes RTM frames (orjson if available by default).
+    # RTM frames arriving within `batch_latency` sec. are received at once.
+    def __init__(self, token, scheduler=None, id='Slack', api=None, outbox=None,
+            cache_path=None, json_loads=json_loads, batch_latency=0.005):
+        self._api = api or SlackAPI(token)
+        self.outbox = outbox or SlackOutbox(self._api)
+        self._env = Workspace(cache_path)
+        self._refreshing = set()
+        self._deferred = collections.deque()
+        self._formatter = SlackFormatter(self._lookup_user_name,
+                self._lookup_channel_name)
         self._ws = None
         self._retry = 0
         self._sched = scheduler or Scheduler()
+        self._json_loads = json_loads
+        self._batch_latency = batch_latency
         self._event_handlers = {}
+        self._ignored = set()
         for ty in RTM_EVENT_TYPES:
             self._event_handlers[ty] = getattr(self, '_'+ty)
+            if getattr(type(self), '_'+ty) is Slack._ignore:
+                self._ignored.add(ty)
 
         # launch chat room after initialization
         super().__init__(id=id)
 
         self.listen('slack:connect', self._connect)
+        self.listen('slack:fetched', self._fetched)
         self.listen('ws:receive', self._receive)
+        self.listen('ws:receive_batch', self._receive_batch)
+        self.listen('ws:close', self._closed)
         self.send('slack:connect')
 
     def _post(self, mail):
@@ -103,281 +377,349 @@ class Slack(Chat):
         if to:
             params['text'] = '@%s %s' % (to, params['text'])
         params['link_names'] = 1
-        self._api.send('chat.post_message', params)
+        self.outbox.post(params)
 
     def on_fail(self, exc_type, exc_value, traceback):
-        if self._env:
-            self._env = None
         if self._ws:
             self._ws.send('ws:stop')
             self._ws = None
         self._sched.timer(self, 'slack:connect',
             seconds = SLACK_RESTART_WAITTIMES[self._retry])
 
+    # RTM urls can not be reused; reconnect with a new one
+    def _closed(self, mail):
+        if mail['ws'] is not self._ws:
+            return
+        logger.warning('Disconnected from Slack: %s', mail['reason'])
+        self._ws = None
+        self._sched.timer(self, 'slack:connect',
+            seconds = SLACK_RESTART_WAITTIMES[self._retry])
+
     def _connect(self, mail):
         logger.info('%s connecting to Slack', ["Retry","Try"][self._retry==0])
 
         if self._retry + 1 < len(SLACK_RESTART_WAITTIMES):
             self._retry += 1
 
-        info = self._api.request('rtm.start').get()
-
-        self._env = {
-            'team': info['team'],
-            'users': {user['id']: user for user in info['users']},
-            'channels': {chan['id']: chan for chan in info['channels']},
-            'groups': {group['id']: group for group in info['groups']},
-            'ims': {im['id']: im for im in info['ims']},
-        }
+        if 'team' in self._env:
+            info = self._api.request('rtm.connect').get()
+            self._env.update('team', 'team', info['team'])
+        else:
+            info = self._api.request('rtm.start').get()
+            self._env.put('team', 'team', info['team'])
+            for kind in ('users', 'channels', 'groups', 'ims'):
+                self._env.replace(kind, {e['id']: e for e in info[kind]})
 
-        self._ws = WebSocket(info['url'])
+        self._ws = WebSocket(info['url'], batch_latency=self._batch_latency)
 
         # make sure to complete adding Slack as a consumer of the websocket
         # before start it.
         self._ws.request('ws:add_consumer', {'consumer': self}).wait(1)
         self._ws.send('ws:start')
 
+    # True if events of type `ty` are handled or subscribed by bots
+    def _interesting(self, ty):
+        return ty not in self._ignored or self._subscribed(ty)
+
     def _receive(self, packet):
-        mail = json.loads(packet['data'])
+        self._receive_frame(packet['data'])
+
+    # a frame failing to be handled does not drop the rest of the batch
+    def _receive_batch(self, packet):
+        for data in packet['data']:
+            try:
+                self._receive_frame(data)
+            except Exception:
+                logger.error('Failed to handle Slack event: %s', data,
+                        exc_info=sys.exc_info())
+
+    def _receive_frame(self, data):
+        # the type is sniffed only if "type" appears once; nested objects
+        # may have types of their own
+        if isinstance(data, str) and data.count('"type"') == 1:
+            m = _FRAME_TYPE.search(data)
+            if m and not self._interesting(m.group(1)):
+                return
+        mail = self._json_loads(data)
         ty = mail.pop('type', None)
         if ty is None:
-            logger.info('Unknown Slack event: %s', packet['data'])
+            logger.info('Unknown Slack event: %s', data)
             return
 
         h = self._event_handlers.get(ty)
         if h is None:
-            logger.info('Unknown Slack event: %s', packet['data'])
+            logger.info('Unknown Slack event: %s', data)
             return
 
         h(mail)
-        self.deliver(ty, mail)
+        if self._subscribed(ty):
+            self.deliver(ty, mail)
+
+    # API method and its argument to fetch an entity of each kind
+    _FETCH = {
+        'team': ('team.info', None, 'team'),
+        'users': ('users.info', 'user', 'user'),
+        'channels': ('channels.info', 'channel', 'channel'),
+        'groups': ('groups.info', 'channel', 'group'),
+        }
 
+    def _fetch(self, kind, id):
+        method, arg, _ = self._FETCH[kind]
+        return self._api.request(method, {arg: id} if arg else {})
+
+    # cached entity or None; fetched in the background if it is not cached
+    # or stale. The RTM stream is never blocked on the API.
+    def _resolve(self, kind, id):
+        entity = self._env.get(kind, id)
+        if (entity is None or self._env.stale(kind, id)) and (kind, id) not in self._refreshing:
+            self._refreshing.add((kind, id))
+            field = self._FETCH[kind][2]
+            def fetched(f):
+                entity = None
+                try:
+                    entity = f.result()[field]
+                except Exception as e:
+                    logger.warning('Failed to fetch %s %s: %r', kind, id, e)
+                finally:
+                    self.send('slack:fetched', {'kind': kind, 'id': id, 'entity': entity})
+            self._fetch(kind, id).add_done_callback(fetched)
+        return entity
+
+    def _fetched(self, mail):
+        kind, id = mail['kind'], mail['id']
+        try:
+            if mail['entity'] is not None:
+                self._env.put(kind, id, mail['entity'])
+                self._formatter.invalidate(id)
+        finally:
+            self._refreshing.discard((kind, id))
+            self._flush_deferred()
+
+    # names of entities not cached yet are looked up later; see _message
+    def _lookup_user_name(self, id):
+        entity = self._resolve('users', id)
+        if entity is None:
+            raise KeyError(id)
+        return entity['name']
+
+    def _lookup_channel_name(self, id):
+        entity = self._resolve('channels' if id[0] == 'C' else 'groups', id)
+        if entity is None:
+            raise KeyError(id)
+        return '#' + entity['name']
+
+    # ids of users and channels which are not cached are returned as is
     def get_user_name(self, id):
-        return self._env['users'][id]['name']
+        try:
+            return self._formatter.user(id)
+        except KeyError:
+            return id
 
     def get_channel_name(self, id):
-        if id[0] == 'C':
-            return '#' + self._env['channels'][id]['name']
-        elif id[0] == 'G':
-            return '#' + self._env['groups'][id]['name']
-        else:
+        try:
+            return self._formatter.channel(id)
+        except KeyError:
             return id
-    
-    def _unescape(self, m):
-        if m.group(2):
-            return '@' + self.get_user_name(m.group(2))
-        elif m.group(5):
-            return '#' + self.get_channel_name(m.group(5))
-        else:
-            return m.group(7)
 
-    # slack's formatted texts to readable texts 
+    # (kind, id) of users and channels referred to by a message
+    def _references(self, mail):
+        yield 'users', mail.get('user')
+        channel = mail.get('channel') or ''
+        yield {'C': 'channels', 'G': 'groups'}.get(channel[:1]), channel
+        for sigil, id in _REFERENCE.findall(mail.get('text') or ''):
+            if sigil == '@':
+                yield 'users', id
+            else:
+                yield {'C': 'channels', 'G': 'groups'}.get(id[:1]), id
+
+    # True if the message refers to entities being fetched for the first time
+    def _unresolved(self, mail):
+        return any(kind and id and (kind, id) in self._refreshing
+                and self._env.get(kind, id) is None
+                for kind, id in self._references(mail))
+
+    # deliver deferred messages, in order, as far as their references are fetched
+    def _flush_deferred(self):
+        while self._deferred and not self._unresolved(self._deferred[0]):
+            self._deliver_message(self._deferred.popleft())
+
+    # slack's formatted texts to readable texts
     def _unescape_text(self, text):
-        # See https://api.slack.com/docs/formatting
-        return re.sub(r"<(@(\w+)(\|[^>]+)?)|(#(\w+)(\|[^>]+)?)|(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)>",
-                self._unescape, text).replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+        return self._formatter.format(text)
 
 
     # Event handlers
+    # Events handled by _ignore and not subscribed by any bot are dropped
+    # without being decoded.
+    def _ignore(self, mail):
+        pass
+
     def _hello(self, mail):
-        logger.info('Successfully connected to %s\'s Slack', self._env['team']['name'])
+        team = self._resolve('team', 'team') or {}
+        logger.info('Successfully connected to %s\'s Slack', team.get('name', 'the team'))
         self._retry = 0
 
     # Unescape values, usernames
+    # Messages referring to users or channels which are not cached wait
+    # (in order) until they are fetched instead of blocking the RTM stream.
     def _message(self, mail):
         mail = dict(mail)
-        if 'subtype' in mail:
+        if 'subtype' in mail or not self._subscribed('chat:message'):
             return
+        for kind, id in self._references(mail):
+            if kind and id:
+                self._resolve(kind, id)
+        if self._deferred or self._unresolved(mail):
+            self._deferred.append(mail)
+        else:
+            self._deliver_message(mail)
+
+    def _deliver_message(self, mail):
         mail['text'] = self._unescape_text(mail['text'])
         mail['user']    = self.get_user_name(mail['user'])
         mail['channel'] = self.get_channel_name(mail['channel'])
         self.deliver('chat:message', mail)
 
-    def _user_typing(self, mail):
-        pass
+    _user_typing = _ignore
 
     def _channel_marked(self, mail):
-        channel = self._env['channels'].get(mail['channel'])
-        if channel:
-            channel['last_read'] = message['ts']
+        self._env.update('channels', mail['channel'], {'last_read': mail['ts']})
 
     def _channel_created(self, mail):
         channel = mail['channel']
-        self._env['channels'][channel['id']] = channel
+        self._env.put('channels', channel['id'], channel)
 
     def _channel_joined(self, mail):
         channel = mail['channel']
-        self._env['channels'][channel['id']] = channel
+        self._env.put('channels', channel['id'], channel)
 
     def _channel_left(self, mail):
-        self._env['channels'].pop(mail['channel'], None)
+        self._env.remove('channels', mail['channel'])
 
     def _channel_deleted(self, mail):
-        self._env['channels'].pop(mail['channel'], None)
+        self._env.remove('channels', mail['channel'])
 
     def _channel_rename(self, mail):
-        channel = self._env['channels'].get(mail['channel']['id'])
-        if channel:
-            channel['name'] = mail['channel']['name']
+        self._env.update('channels', mail['channel']['id'], {'name': mail['channel']['name']})
+        self._formatter.invalidate(mail['channel']['id'])
 
     def _channel_archive(self, mail):
-        channel = self._env['channels'].get(mail['channel'])
-        if channel:
-            channel['is_archived'] = True
+        self._env.update('channels', mail['channel'], {'is_archived': True})
 
     def _channel_unarchive(self, mail):
-        channel = self._env['channels'].get(mail['channel'])
-        if channel:
-            channel['is_archived'] = False
+        self._env.update('channels', mail['channel'], {'is_archived': False})
 
-    def _channel_history_changed(self, mail):
-        pass
+    _channel_history_changed = _ignore
 
     def _im_created(self, mail):
         im = mail['channel']
-        self._env['ims'][im['id']] = im
+        self._env.put('ims', im['id'], im)
 
-    def _im_open(self, mail):
-        pass
+    _im_open = _ignore
 
-    def _im_close(self, mail):
-        pass
+    _im_close = _ignore
 
     def _im_marked(self, mail):
-        im = self._env['ims'].get(mail['channel'])
-        if im:
-            im['last_read'] = message['ts']
+        self._env.update('ims', mail['channel'], {'last_read': mail['ts']})
 
-    def _im_history_changed(self, mail):
-        pass
+    _im_history_changed = _ignore
 
     def _group_joined(self, mail):
         group = mail['group']
-        self._env['groups'][group['id']] = group
+        self._env.put('groups', group['id'], group)
 
     def _group_left(self, mail):
-        self._env['groups'].pop(mail['channel'], None)
+        self._env.remove('groups', mail['channel'])
 
-    def _group_open(self, mail):
-        pass
+    _group_open = _ignore
 
-    def _group_close(self, mail):
-        pass
+    _group_close = _ignore
 
     def _group_archive(self, mail):
-        group = self._env['groups'].get(mail['channel'])
-        if group:
-            group['is_archived'] = True
+        self._env.update('groups', mail['channel'], {'is_archived': True})
 
     def _group_unarchive(self, mail):
-        group = self._env['groups'].get(mail['channel'])
-        if group:
-            group['is_archived'] = False
+        self._env.update('groups', mail['channel'], {'is_archived': False})
 
     def _group_rename(self, mail):
-        group = self._env['groups'].get(mail['channel']['id'])
-        if group:
-            group['name'] = mail['channel']['name']
+        self._env.update('groups', mail['channel']['id'], {'name': mail['channel']['name']})
+        self._formatter.invalidate(mail['channel']['id'])
 
     def _group_marked(self, mail):
-        group = self._env['groups'].get(mail['channel'])
-        if group:
-            group['last_read'] = message['ts']
+        self._env.update('groups', mail['channel'], {'last_read': mail['ts']})
 
-    def _group_history_changed(self, mail):
-        pass
+    _group_history_changed = _ignore
 
-    def _file_created(self, mail):
-        pass
+    _file_created = _ignore
 
-    def _file_shared(self, mail):
-        pass
+    _file_shared = _ignore
 
-    def _file_unshared(self, mail):
-        pass
+    _file_unshared = _ignore
 
-    def _file_public(self, mail):
-        pass
+    _file_public = _ignore
 
-    def _file_private(self, mail):
-        pass
+    _file_private = _ignore
 
-    def _file_change(self, mail):
-        pass
+    _file_change = _ignore
 
-    def _file_deleted(self, mail):
-        pass
+    _file_deleted = _ignore
 
-    def _file_comment_added(self, mail):
-        pass
+    _file_comment_added = _ignore
 
-    def _file_comment_edited(self, mail):
-        pass
+    _file_comment_edited = _ignore
 
-    def _file_comment_deleted(self, mail):
-        pass
+    _file_comment_deleted = _ignore
 
-    def _pin_added(self, mail):
-        pass
+    _pin_added = _ignore
 
-    def _pin_removed(self, mail):
-        pass
+    _pin_removed = _ignore
 
-    def _presence_change(self, mail):
-        pass
+    _presence_change = _ignore
 
-    def _manual_presence_change(self, mail):
-        pass
+    _manual_presence_change = _ignore
 
-    def _pref_change(self, mail):
-        pass
+    _pref_change = _ignore
 
     def _user_change(self, mail):
         user = mail['user']
-        self._env['users'][user['id']] = user
+        self._env.put('users', user['id'], user)
+        self._formatter.invalidate(user['id'])
 
     def _team_join(self, mail):
         user = mail['user']
-        self._env['users'][user['id']] = user
+        self._env.put('users', user['id'], user)
 
-    def _star_added(self, mail):
-        pass
+    _star_added = _ignore
 
-    def _star_removed(self, mail):
-        pass
+    _star_removed = _ignore
 
-    def _emoji_changed(self, mail):
-        pass
+    _emoji_changed = _ignore
 
-    def _commands_changed(self, mail):
-        pass
+    _commands_changed = _ignore
 
-    def _team_plan_change(self, mail):
-        pass
+    _team_plan_change = _ignore
 
     def _team_pref_change(self, mail):
-        name = message['name']
-        value = message['value']
-        self._env['team']['prefs'][name] = value
+        team = self._env.get('team', 'team')
+        if team:
+            prefs = dict(team.get('prefs', {}))
+            prefs[mail['name']] = mail['value']
+            self._env.update('team', 'team', {'prefs': prefs})
 
     def _team_rename(self, mail):
-        self._env['team']['name'] = message['name']
+        self._env.update('team', 'team', {'name': mail['name']})
 
     def _team_domain_change(self, mail):
-        self._env['team']['domain'] = message['domain']
+        self._env.update('team', 'team', {'domain': mail['domain']})
 
     def _email_domain_changed(self, mail):
-        self._env['team']['email_domain'] = message['email_domain']
+        self._env.update('team', 'team', {'email_domain': mail['email_domain']})
 
-    def _bot_added(self, mail):
-        pass
+    _bot_added = _ignore
 
-    def _bot_changed(self, mail):
-        pass
+    _bot_changed = _ignore
 
-    def _accounts_changed(self, mail):
-        pass
+    _accounts_changed = _ignore
 
-    def _team_migration_started(self, mail):
-        pass
+    _team_migration_started = _ignore
 
@@ -0,0 +1,101 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Persistent cache of the state of a chat workspace ==
+# Users, channels, groups, ims and team information are stored as JSON in
+# one sqlite row per entity, so that updates by events are written
+# incrementally. Entities are loaded on the first reference and kept in
+# memory. Each row records when it was fetched from the server so that
+# stale entities can be refreshed lazily.
+#
+# Not thread-safe; used by the chat actor only.
+
+import json
+import sqlite3
+import time
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entities (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+'''
+
+class Workspace(object):
+    # `path` of the sqlite database; None keeps the cache in memory only.
+    # Entities fetched more than `max_age` sec. ago are stale.
+    def __init__(self, path=None, max_age=24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self._db = sqlite3.connect(path or ':memory:',
+                isolation_level=None, check_same_thread=False)
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        self._loaded = {} # (kind, id) -> [entity, fetched]
+
+    def close(self):
+        self._db.close()
+
+    def __contains__(self, kind):
+        row = self._db.execute('SELECT 1 FROM entities WHERE kind = ? LIMIT 1',
+                (kind,)).fetchone()
+        return row is not None
+
+    def _load(self, kind, id):
+        key = (kind, id)
+        entry = self._loaded.get(key)
+        if entry is None:
+            row = self._db.execute(
+                    'SELECT data, fetched FROM entities WHERE kind = ? AND id = ?',
+                    key).fetchone()
+            if row is None:
+                return None
+            entry = [json.loads(row[0]), row[1]]
+            self._loaded[key] = entry
+        return entry
+
+    # entity `id` of `kind` ('users', 'channels', ...) or None
+    def get(self, kind, id):
+        entry = self._load(kind, id)
+        return entry[0] if entry else None
+
+    def stale(self, kind, id):
+        entry = self._load(kind, id)
+        return entry is None or time.time() - entry[1] > self.max_age
+
+    # store `entity` fetched from the server
+    def put(self, kind, id, entity):
+        now = time.time()
+        self._loaded[(kind, id)] = [entity, now]
+        self._db.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)',
+                (kind, id, json.dumps(entity), now))
+
+    # update fields of a cached entity, keeping the time it was fetched
+    def update(self, kind, id, fields):
+        entry = self._load(kind, id)
+        if entry is None:
+            return
+        entry[0].update(fields)
+        self._db.execute('UPDATE entities SET data = ? WHERE kind = ? AND id = ?',
+                (json.dumps(entry[0]), kind, id))
+
+    def remove(self, kind, id):
+        self._loaded.pop((kind, id), None)
+        self._db.execute('DELETE FROM entities WHERE kind = ? AND id = ?',
+                (kind, id))
+
+    # replace all entities of `kind` by `entities` ({id: entity})
+    def replace(self, kind, entities):
+        now = time.time()
+        for key in [k for k in self._loaded if k[0] == kind]:
+            del self._loaded[key]
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM entities WHERE kind = ?', (kind,))
+            self._db.executemany('INSERT INTO entities VALUES (?, ?, ?, ?)',
+                    ((kind, id, json.dumps(e), now) for id, e in entities.items()))
@@ -0,0 +1,215 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+#== Profiling of actor handlers ==
+# HandlerProfiler hooks Actor._handle of every actor in the process.
+#
+# Slow handlers: a handler running longer than `slow_threshold` sec. is
+# logged with the actor, the tag and a stack sample of the thread running
+# it, while it is still running. Handlers which finish late are logged with
+# their elapsed time.
+#
+# mode:
+#   None            only detect slow handlers
+#   'sampling'      sample the stacks of running handlers every `interval`
+#                   sec. and count them per (actor class, tag)
+#   'deterministic' run handlers under cProfile and aggregate the profiles
+#                   per (actor class, tag). Each thread has its own profile;
+#                   stats() and report() merge them.
+#
+# Running handlers are tracked per call. Coroutine handlers of AsyncActor are
+# tracked until the coroutine finishes and sampled at the point where they
+# wait; cProfile covers them until they return the coroutine object only.
+
+import cProfile
+import collections
+import inspect
+import itertools
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+from carnival import actor
+from carnival.logging import logger
+
+class HandlerProfiler(object):
+    MODES = (None, 'sampling', 'deterministic')
+
+    def __init__(self, slow_threshold=1.0, mode=None, interval=0.01):
+        if mode not in HandlerProfiler.MODES:
+            raise ValueError('Unknown profiling mode', mode)
+        self.slow_threshold = slow_threshold
+        self.mode = mode
+        self.interval = interval
+        # call id -> [actor, tag, start time, reported, thread id, coroutine]
+        self._running = {}
+        self._calls = itertools.count()
+        self._profiles = {} # (actor class, tag) -> {thread id: cProfile.Profile}
+        self._samples = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+        actor.set_handler_hook(self._call)
+
+    def stop(self):
+        actor.set_handler_hook(None)
+        self._stop.set()
+        if self._watchdog:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _call(self, act, tag, handler, mail):
+        ident = threading.get_ident()
+        key = next(self._calls)
+        entry = [act, tag, time.perf_counter(), False, ident, None]
+        self._running[key] = entry
+        prof = None
+        if self.mode == 'deterministic':
+            prof = self._profile((type(act).__name__, tag), ident)
+            try:
+                prof.enable()
+            except ValueError:
+                # another profiler is active on this thread
+                prof = None
+        result = None
+        try:
+            result = handler(mail)
+        finally:
+            if prof:
+                prof.disable()
+            coroutine = isinstance(act, actor.AsyncActor) and \
+                    inspect.iscoroutine(result)
+            if not coroutine:
+                self._finish(key, entry)
+        if coroutine:
+            entry[5] = result
+            return self._await(key, entry, result)
+        return result
+
+    async def _await(self, key, entry, coroutine):
+        try:
+            return await coroutine
+        finally:
+            self._finish(key, entry)
+
+    def _finish(self, key, entry):
+        del self._running[key]
+        elapsed = time.perf_counter() - entry[2]
+        if elapsed >= self.slow_threshold and not entry[3]:
+            logger.warning('Slow handler %s of %s took %.3f sec',
+                    entry[1], entry[0], elapsed)
+
+    def _profile(self, key, ident):
+        profiles = self._profiles.get(key)
+        prof = profiles.get(ident) if profiles else None
+        if prof is None:
+            with self._lock:
+                prof = self._profiles.setdefault(key, {}).setdefault(
+                        ident, cProfile.Profile())
+        return prof
+
+    def _watch(self):
+        interval = self.slow_threshold / 4
+        if self.mode == 'sampling':
+            interval = min(interval, self.interval)
+        while not self._stop.wait(interval):
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            for entry in list(self._running.values()):
+                act, tag, start, reported, ident, coroutine = entry
+                if coroutine is not None:
+                    stack = _coroutine_stack(coroutine)
+                else:
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = traceback.extract_stack(frame)
+                if self.mode == 'sampling':
+                    sample = tuple('%s:%d(%s)' % (f.filename, f.lineno, f.name)
+                            for f in stack)
+                    with self._lock:
+                        self._samples[(type(act).__name__, tag)][sample] += 1
+                if not reported and now - start >= self.slow_threshold:
+                    entry[3] = True
+                    logger.warning('Slow handler %s of %s running for %.3f sec:\n%s',
+                            tag, act, now - start,
+                            ''.join(traceback.format_list(stack)))
+            del frames
+
+    # pstats.Stats of the handlers of `tag` of actor class `klass` ('deterministic')
+    def stats(self, klass, tag):
+        with self._lock:
+            profiles = list(self._profiles.get((klass, tag), {}).values())
+        if not profiles:
+            return None
+        return pstats.Stats(*map(_Snapshot, profiles))
+
+    # Top `limit` entries per (actor class, tag): functions by cumulative
+    # time ('deterministic') or stacks by number of samples ('sampling').
+    def report(self, limit=20):
+        report = {}
+        if self.mode == 'deterministic':
+            with self._lock:
+                profiles = [(key, list(d.values()))
+                        for key, d in self._profiles.items()]
+            for (klass, tag), profs in profiles:
+                stats = pstats.Stats(*map(_Snapshot, profs)).stats
+                entries = sorted(stats.items(), key=lambda e: e[1][3],
+                        reverse=True)[:limit]
+                report['%s:%s' % (klass, tag)] = [{
+                    'function': '%s:%d(%s)' % func,
+                    'calls': nc,
+                    'total': tt,
+                    'cumulative': ct,
+                    } for func, (cc, nc, tt, ct, callers) in entries]
+        elif self.mode == 'sampling':
+            with self._lock:
+                samples = {k: c.most_common(limit)
+                        for k, c in self._samples.items()}
+            for (klass, tag), stacks in samples.items():
+                report['%s:%s' % (klass, tag)] = [{
+                    'stack': list(stack),
+                    'samples': n,
+                    } for stack, n in stacks]
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._profiles = {}
+            self._samples.clear()
+
+# Stats of a profile which may be running on another thread. pstats.Stats
+# would disable it.
+class _Snapshot(object):
+    def __init__(self, prof):
+        self._prof = prof
+
+    def create_stats(self):
+        self._prof.snapshot_stats()
+        self.stats = self._prof.stats
+
+# FrameSummaries from the outermost coroutine to the one it waits for
+def _coroutine_stack(coroutine):
+    stack = traceback.StackSummary()
+    while coroutine is not None:
+        frame = getattr(coroutine, 'cr_frame', None)
+        if frame is None:
+            break
+        stack.append(traceback.FrameSummary(frame.f_code.co_filename,
+            frame.f_lineno, frame.f_code.co_name, lookup_line=False))
+        coroutine = getattr(coroutine, 'cr_await', None)
+    return stack
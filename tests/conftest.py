@@ -0,0 +1,19 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+# The repository is the carnival package; import it as `carnival` whatever
+# the checkout directory is named.
+
+import importlib.util
+import os
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'carnival' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('carnival',
+            os.path.join(_ROOT, '__init__.py'),
+            submodule_search_locations=[_ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['carnival'] = module
+    spec.loader.exec_module(module)
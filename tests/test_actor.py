@@ -0,0 +1,305 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+import carnival
+
+_ids = itertools.count()
+
+def _id(name):
+    return '%s%d' % (name, next(_ids))
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.fixture
+def actors():
+    yield
+    carnival.stopall()
+
+# Pooled actors suspend whenever their mailbox is empty, so each ball is
+# likely to arrive while its receiver is suspending and must restart it.
+def test_pooled_ping_pong(actors):
+    pool = carnival.Dispatcher(workers=2)
+    done = threading.Event()
+
+    class Player(carnival.PooledActor):
+        dispatcher = pool
+
+        def __init__(self, id):
+            super().__init__(id=id)
+            self.listen('ball', self.ball)
+
+        def ball(self, mail):
+            if mail['n'] == 0:
+                done.set()
+            else:
+                carnival.send(mail['to'], 'ball',
+                        {'n': mail['n'] - 1, 'to': self.id})
+
+    ping, pong = Player(_id('ping')), Player(_id('pong'))
+    ping.send('ball', {'n': 2000, 'to': pong.id})
+    assert done.wait(10)
+
+# The handler holds the only worker while waiting for the reply of an actor
+# of the same dispatcher.
+def test_dispatcher_adds_workers_when_blocked(actors):
+    pool = carnival.Dispatcher(workers=1, stall_timeout=0.1)
+
+    class Asker(carnival.PooledActor):
+        dispatcher = pool
+
+        def __init__(self, id, peer=None):
+            super().__init__(id=id)
+            self.peer = peer
+            self.listen('ask', self.ask)
+            self.listen('answer', lambda mail: 42)
+
+        def ask(self, mail):
+            return self.peer.request('answer').get(5)
+
+    asker = Asker(_id('asker'), Asker(_id('answerer')))
+    assert asker.request('ask').get(5) == 42
+
+def test_async_actor_awaits_coroutine_handlers(actors):
+    class Napper(carnival.AsyncActor):
+        def __init__(self, id):
+            super().__init__(id=id)
+            self.listen('nap', self.nap)
+
+        async def nap(self, mail):
+            await asyncio.sleep(0.01)
+            return mail['n'] + 1
+
+    napper = Napper(_id('napper'))
+    futures = [napper.request('nap', {'n': n}) for n in range(10)]
+    assert [f.get(5) for f in futures] == list(range(1, 11))
+
+# The timeout is enforced while a handler blocks the shared event loop.
+def test_request_timeout_with_a_blocked_event_loop(actors):
+    class Blocker(carnival.AsyncActor):
+        def __init__(self):
+            super().__init__()
+            self.listen('block', lambda mail: time.sleep(0.5))
+
+    release = threading.Event()
+
+    class Silent(carnival.ThreadingActor):
+        def __init__(self):
+            super().__init__()
+            self.listen('ask', lambda mail: release.wait(5))
+
+    Blocker().send('block')
+    start = time.monotonic()
+    future = Silent().request('ask', timeout=0.1)
+    assert future.get(5) is None
+    assert time.monotonic() - start < 0.4
+    assert future.tag not in carnival.Future._pending
+    release.set()
+
+class _Batches(carnival.ThreadingActor):
+    batch_size = 20
+
+    def __init__(self, id=None):
+        super().__init__(id=id)
+        self.batches = []
+
+    def handle_batch(self, mails):
+        self.batches.append([mail for _, mail in mails])
+
+class _AsyncBatches(carnival.AsyncActor):
+    batch_size = 20
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    async def handle_batch(self, mails):
+        await asyncio.sleep(0)
+        self.batches.append([mail for _, mail in mails])
+
+@pytest.mark.parametrize('klass', [_Batches, _AsyncBatches])
+def test_send_many_is_handled_in_batches(actors, klass):
+    actor = klass()
+    actor.send_many('item', range(50))
+    _wait(lambda: sum(map(len, actor.batches)) == 50)
+    assert [mail for batch in actor.batches for mail in batch] == list(range(50))
+    assert [len(batch) for batch in actor.batches] == [20, 20, 10]
+
+@pytest.mark.parametrize('overflow, queued', [
+    ('drop_new', [0, 1]),
+    ('drop_old', [2, 3]),
+    ])
+def test_overflow_discards(overflow, queued):
+    box = carnival.Mailbox(2, overflow)
+    box.put_many([('x', n) for n in range(4)])
+    assert [mail for _, mail in box.get_many(10)] == queued
+    assert box.overflows == 2
+
+def test_overflow_rejects():
+    box = carnival.Mailbox(1, 'reject')
+    box.put(('x', 0))
+    with pytest.raises(carnival.MailboxFull):
+        box.put(('x', 1))
+    box.put(('actor:stop', None), control=True) # never refused
+    assert box.qsize() == 2
+    assert box.overflows == 1
+
+def test_overflow_blocks():
+    box = carnival.Mailbox(1, 'block', timeout=0.05)
+    box.put(('x', 0))
+    with pytest.raises(carnival.MailboxFull):
+        box.put(('x', 1))
+
+    box.timeout = 5
+    threading.Timer(0.05, box.get).start()
+    box.put(('x', 2))
+    assert box.get_many(10) == [('x', 2)]
+
+# Handles messages after `gate` is set. `entered` is set when the actor
+# waits for the gate, i.e. its mailbox is empty.
+class _Gated(carnival.ThreadingActor):
+    def __init__(self, id=None):
+        super().__init__(id=id)
+        self.gate = threading.Event()
+        self.entered = threading.Event()
+        self.listen('gate', self.wait)
+
+    def wait(self, mail):
+        self.entered.set()
+        self.gate.wait(5)
+
+@pytest.fixture
+def gated(actors):
+    created = []
+    def create(klass=_Gated, **kwargs):
+        actor = klass(**kwargs)
+        created.append(actor)
+        actor.send('gate')
+        assert actor.entered.wait(5)
+        return actor
+    yield create
+    for actor in created:
+        actor.gate.set()
+
+# Control messages count against the capacity, so that of the mailboxes of
+# gated actors leaves room for the listen and gate messages.
+class _DropOld(_Gated):
+    mailbox_size = 2
+    overflow = 'drop_old'
+
+# The callback of a discarded request sends to the actor whose mailbox
+# discarded it, which discards the next request in turn.
+def test_discarded_requests_fail(gated):
+    actor = gated(_DropOld)
+    first = actor.request('x')
+    second = actor.request('x')
+    first.add_done_callback(lambda f: actor.send('x'))
+    actor.request('x')
+    for future in (first, second):
+        with pytest.raises(carnival.MailboxFull):
+            future.result(5)
+        assert future.tag not in carnival.Future._pending
+    assert actor.overflows == 2
+
+class _Reject(_Gated):
+    mailbox_size = 2
+    overflow = 'reject'
+
+def test_refused_request_is_forgotten(gated):
+    actor = gated(_Reject)
+    actor.send_many('x', [{}, {}])
+    pending = len(carnival.Future._pending)
+    with pytest.raises(carnival.MailboxFull):
+        actor.request('x')
+    assert len(carnival.Future._pending) == pending
+
+class _Ordered(_Gated):
+    priority_tags = {
+        'urgent': carnival.PRIORITY_HIGH,
+        'later': carnival.PRIORITY_LOW,
+        }
+
+    def __init__(self, id=None):
+        super().__init__(id=id)
+        self.received = []
+        self.suspended = threading.Event()
+        for tag in ('urgent', 'normal', 'later'):
+            self.listen(tag, lambda mail: self.received.append(mail['n']))
+
+    def on_suspend(self):
+        self.suspended.set()
+
+# Queued messages are taken by priority. The stop is taken first but the
+# actor suspends only after the backlog is processed.
+def test_priority_and_stop_order(gated):
+    actor = gated(_Ordered, id=_id('ordered'))
+    actor.send('later', {'n': 1})
+    actor.send('normal', {'n': 2})
+    carnival.stopall(_Ordered)
+    actor.send('urgent', {'n': 3})
+    actor.send('normal', {'n': 4})
+    actor.send('normal', {'n': 5}, priority=carnival.PRIORITY_HIGH)
+    actor.gate.set()
+    assert actor.suspended.wait(5)
+    assert actor.received == [3, 5, 2, 4, 1]
+
+class _Prices(_Gated):
+    coalesce_keys = {'price': lambda mail: mail['symbol']}
+
+    def __init__(self):
+        super().__init__()
+        self.received = []
+        self.listen('price', self.price)
+
+    def price(self, mail):
+        self.received.append((mail['symbol'], mail['value']))
+        return mail['value']
+
+# A newer mail replaces a queued one of the same key in its place; requests
+# are not coalesced.
+def test_coalescing_keeps_the_latest_mail(gated):
+    actor = gated(_Prices)
+    for symbol, value in [('A', 1), ('B', 1), ('A', 2), ('A', 3), ('B', 2)]:
+        actor.send('price', {'symbol': symbol, 'value': value})
+    future = actor.request('price', {'symbol': 'A', 'value': 4})
+    actor.gate.set()
+    assert future.get(5) == 4
+    assert actor.received == [('A', 3), ('B', 2), ('A', 4)]
+
+class _Measured(_Batches):
+    coalesce_keys = {'price': lambda mail: mail['symbol']}
+
+    def __init__(self, id):
+        super().__init__(id=id)
+        self.listen('echo', lambda mail: mail['value'])
+        self.listen('fail', lambda mail: 1 / 0)
+
+def test_metrics(actors):
+    actor = _Measured(_id('measured'))
+    for n in range(3):
+        assert actor.request('echo', {'value': n}).get(5) == n
+    with pytest.raises(ZeroDivisionError):
+        actor.request('fail').get(5)
+    actor.send_many('item', range(5))
+    actor.send_many('price', [{'symbol': 'A'}] * 3)
+
+    def processed(tag):
+        return actor.metrics()['tags'].get(tag, {}).get('processed')
+    _wait(lambda: processed('echo') == 3 and processed('actor:batch') == 6)
+    stats = carnival.metrics(_Measured)[actor.id]
+    assert stats['tags']['echo']['queue_time']['count'] == 3
+    assert stats['tags']['echo']['handler_time']['total'] > 0
+    assert stats['failures'] == 1
+    assert stats['coalesced'] == 2
+    assert stats['depth'] == 0
+    assert stats['activations'] == 1
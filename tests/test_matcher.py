@@ -0,0 +1,58 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+import re
+import sys
+
+from carnival.bot.matcher import Matcher, required_literals, _fold
+
+PATTERNS = [
+    ('hi', re.I),
+    ('kit', re.I),
+    ('is this', re.I),
+    ('(?i:Sing)ular', 0),
+    ('deploy (staging|production)', re.I),
+    ('ping|pong', 0),
+    ('ı', 0),
+    ('İstanbul', 0),
+    ('straße', re.I),
+    (r'\d+ items', 0),
+    ('(?:ab)+c', 0),
+    ('x*', 0),
+    ]
+
+TEXTS = [
+    '', 'hi', 'HI', 'hı', 'Hİ', 'say hİ there', 'KIT', 'KIT', 'kıt',
+    'IS THİS', 'ıs thıs', 'ſingular', 'SINGular', 'singULAR', 'deploy STAGING',
+    'DEPLOY productıon', 'ping', 'PONG', 'ı', 'I', 'İstanbul', 'istanbul',
+    'STRASSE', 'STRAẞE', 'strasse', '12 items', 'ababc', 'ab c', 'nothing',
+    ]
+
+def _matcher():
+    matcher = Matcher()
+    rules = []
+    for i, (pattern, flags) in enumerate(PATTERNS):
+        p = re.compile(pattern, flags)
+        matcher.add(p, i)
+        rules.append((p, i))
+    return matcher, rules
+
+def test_search_agrees_with_re_search():
+    matcher, rules = _matcher()
+    for text in TEXTS:
+        expected = [i for p, i in rules if p.search(text)]
+        assert [i for i, m in matcher.search(text)] == expected, text
+
+def test_literals_are_extracted():
+    assert required_literals(re.compile('hi', re.I)) == {'hi'}
+    assert required_literals(re.compile('alpha|omega')) == {'alpha', 'omega'}
+    assert required_literals(re.compile('x*')) is None
+
+# every character matching an ASCII character under IGNORECASE folds like it
+def test_fold_covers_ignorecase_equivalents():
+    chars = ''.join(chr(i) for i in range(sys.maxunicode + 1)
+            if not 0xd800 <= i < 0xe000)
+    for i in range(128):
+        c = chr(i)
+        for m in re.finditer(re.escape(c), chars, re.I):
+            assert _fold(m.group()) == _fold(c), (c, m.group())
@@ -0,0 +1,131 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+import itertools
+import os
+import threading
+import time
+
+import pytest
+
+import carnival
+
+_ids = itertools.count()
+
+def _id(name):
+    return '%s%d' % (name, next(_ids))
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+# Hosted classes are pickled by reference, so they are defined at module
+# level.
+class Hosted(carnival.ProcessActor):
+    def __init__(self, id=None, peer=None, watcher=None):
+        super().__init__(id=id)
+        self.peer = peer
+        self.watcher = watcher
+        self.listen('pid', self.pid)
+        self.listen('echo', self.echo)
+        self.listen('ask', self.ask)
+        self.listen('slow', self.slow)
+        self.listen('measure', self.measure)
+        self.listen('forward', self.forward)
+
+    def pid(self, mail):
+        return os.getpid()
+
+    def echo(self, mail):
+        return mail['value']
+
+    def ask(self, mail):
+        return self.peer.request('pid').get(5)
+
+    def on_suspend(self):
+        if self.watcher:
+            self.watcher.send('suspended')
+
+    def slow(self, mail):
+        time.sleep(0.2)
+
+    def measure(self, mail):
+        data = mail['data']
+        return type(data).__name__, len(data), bytes(data[:2])
+
+    def forward(self, mail):
+        self.peer.send('data', {'data': bytes(mail['n'])})
+
+# a pool of one worker, so that all actors are hosted by the same process
+@pytest.fixture
+def pool():
+    pool = Hosted.pool = carnival.ProcessPool(workers=1)
+    yield pool
+    carnival.stopall()
+    pool.shutdown()
+    Hosted.pool = None
+
+def test_round_trip(pool):
+    actor = Hosted(_id('hosted'))
+    pid = actor.request('pid').get(5)
+    assert pid != os.getpid()
+    assert actor.request('echo', {'value': [1, {'a': 'b'}]}).get(5) == [1, {'a': 'b'}]
+    assert carnival.get(actor.id) is actor
+
+# A handler blocks on a request to an actor hosted by the same worker.
+def test_request_to_an_actor_of_the_same_worker(pool):
+    answerer = Hosted(_id('answerer'))
+    asker = Hosted(peer=answerer.ref())
+    assert asker.request('ask').get(5) == answerer.request('pid').get(5)
+
+# A mail which the worker can not unpickle fails its request and the actor
+# keeps working.
+def test_unpicklable_mail_fails_its_request(pool):
+    actor = Hosted(_id('hosted'))
+    actor.request('pid').get(5) # the worker started
+    late = globals()['Late'] = type('Late', (object,), {})
+    try:
+        with pytest.raises(RuntimeError):
+            actor.request('echo', {'value': late()}).result(5)
+    finally:
+        del globals()['Late']
+    assert actor.request('echo', {'value': 1}).get(5) == 1
+
+class _Watcher(carnival.ThreadingActor):
+    def __init__(self, id):
+        super().__init__(id=id)
+        self.suspended = threading.Event()
+        self.listen('suspended', lambda mail: self.suspended.set())
+
+def test_stopall_stops_hosted_actors(pool):
+    watcher = _Watcher(_id('watcher'))
+    actor = Hosted(_id('hosted'), watcher=watcher.ref())
+    actor.send('slow')
+    carnival.stopall(Hosted)
+    # an idle actor would suspend only after _QUEUE_TIMEOUT
+    assert watcher.suspended.wait(2)
+
+class _Receiver(carnival.ThreadingActor):
+    def __init__(self, id):
+        super().__init__(id=id)
+        self.received = []
+        self.listen('data', self.data)
+
+    def data(self, mail):
+        view = mail['data']
+        self.received.append((type(view).__name__, len(view)))
+
+# Buffers larger than the threshold of the pool arrive as memoryviews of
+# shared memory in both directions.
+def test_large_buffers_are_shared(pool):
+    receiver = _Receiver(_id('receiver'))
+    actor = Hosted(_id('hosted'), peer=receiver.ref())
+    assert actor.request('measure', {'data': b'xy' * 100000}).get(5) == (
+            'memoryview', 200000, b'xy')
+    assert actor.request('measure', {'data': b'xy'}).get(5) == ('bytes', 2, b'xy')
+
+    actor.send('forward', {'n': 100000})
+    _wait(lambda: receiver.received)
+    assert receiver.received == [('memoryview', 100000)]
@@ -0,0 +1,99 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+import itertools
+import time
+
+import pytest
+
+import carnival
+from carnival import Registry
+
+_ids = itertools.count()
+
+def _id(name):
+    return '%s%d' % (name, next(_ids))
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+class _Named(carnival.ThreadingActor):
+    pass
+
+@pytest.fixture
+def actors():
+    yield
+    carnival.stopall()
+
+# A reference caches the actor until it is unregistered and then follows the
+# id to the next actor registered with it.
+def test_refs_follow_registration(actors):
+    a = _Named(_id('named'))
+    ref = carnival.ref(a.id)
+    assert carnival.get(a.id) is a
+    assert ref.resolve() is a
+
+    Registry.unregistor(a)
+    assert carnival.get(a.id) is None
+    assert ref.resolve() is None
+
+    b = _Named(a.id)
+    assert ref.resolve() is b
+    with pytest.raises(RuntimeError):
+        _Named(a.id)
+
+def test_many_registrations(actors):
+    named = [_Named(_id('many')) for _ in range(1000)]
+    assert all(carnival.get(a.id) is a for a in named)
+    for a in named[::2]:
+        Registry.unregistor(a)
+    assert [carnival.get(a.id) for a in named] == [
+            None if i % 2 == 0 else a for i, a in enumerate(named)]
+
+def test_getall_by_class(actors):
+    class Base(carnival.ThreadingActor):
+        pass
+
+    class Derived(Base):
+        pass
+
+    base, derived = Base(_id('base')), Derived(_id('derived'))
+    Base() # anonymous actors are not registered
+    assert set(carnival.getall(Base)) == {base, derived}
+    assert carnival.getall(Derived) == [derived]
+    assert base in carnival.getall()
+
+    Registry.unregistor(derived)
+    assert carnival.getall(Base) == [base]
+    assert carnival.getall(Derived) == []
+
+def test_publish_to_subscribers(actors):
+    class Listener(carnival.ThreadingActor):
+        def __init__(self, id=None):
+            super().__init__(id=id)
+            self.received = []
+            self.listen('news', self.received.append)
+            self.listen('alert', self.received.append)
+
+    named, anonymous, other = Listener(_id('listener')), Listener(), Listener()
+    named.subscribe('news')
+    anonymous.subscribe('news')
+    assert set(Registry.subscribers('news')) == {named, anonymous}
+
+    carnival.publish('news', {'n': 1})
+    carnival.publish('news', {'n': 2}, tag='alert')
+    anonymous.unsubscribe('news')
+    Registry.unregistor(named) # drops its subscriptions
+    carnival.publish('news', {'n': 3})
+    assert Registry.subscribers('news') == []
+
+    expected = [{'n': 1}, {'n': 2}]
+    for actor in (named, anonymous):
+        _wait(lambda: len(actor.received) >= 2)
+    time.sleep(0.05)
+    assert named.received == expected
+    assert anonymous.received == expected
+    assert other.received == []
@@ -0,0 +1,254 @@
+# Copyright (C) 2015 Idein Inc.
+# Author: koichi
+
+# SlackAPI, SlackOutbox and Slack against a local fake Web API server and a
+# local fake RTM websocket server.
+
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('slacker')
+websockets_server = pytest.importorskip('websockets.asyncio.server')
+
+import carnival
+from carnival.chat.slack import Slack, SlackAPI, SlackOutbox
+
+TOKEN = 'xoxb-test'
+
+# Web API answering with `replies[method](params)`; a reply may be a
+# (status, headers, body) tuple. Calls are recorded as (method, params).
+class FakeAPI(object):
+    def __init__(self, replies):
+        self.replies = replies
+        self.calls = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._reply(urllib.parse.urlsplit(self.path).query)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                query = urllib.parse.urlsplit(self.path).query
+                self._reply(query + '&' + self.rfile.read(length).decode())
+
+            def _reply(self, query):
+                method = urllib.parse.urlsplit(self.path).path.rsplit('/', 1)[-1]
+                params = dict(urllib.parse.parse_qsl(query))
+                api.calls.append((method, params))
+                reply = api.replies[method](params)
+                status, headers = 200, {}
+                if isinstance(reply, tuple):
+                    status, headers, reply = reply
+                body = json.dumps(reply).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/api/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def posted(self, channel=None):
+        return [p['text'] for m, p in self.calls
+                if m == 'chat.postMessage' and channel in (None, p['channel'])]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# RTM server sending frames given by send() to the connected client
+class FakeRTM(object):
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._frames = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._server = asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result(5)
+        self.url = 'ws://127.0.0.1:%d/' % self._server.sockets[0].getsockname()[1]
+
+    async def _serve(self):
+        self._frames = asyncio.Queue()
+        return await websockets_server.serve(self._handle, '127.0.0.1', 0)
+
+    async def _handle(self, ws):
+        self._ready.set()
+        while True:
+            frame = await self._frames.get()
+            if frame is None:
+                return
+            await ws.send(json.dumps(frame))
+
+    def send(self, frame):
+        assert self._ready.wait(5)
+        self._loop.call_soon_threadsafe(self._frames.put_nowait, frame)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._frames.put_nowait, None)
+        self._server.close()
+        asyncio.run_coroutine_threadsafe(self._server.wait_closed(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+def _ok(**body):
+    return lambda params: dict(body, ok=True)
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.fixture
+def actors():
+    yield
+    carnival.stopall()
+
+def test_api_calls(actors):
+    server = FakeAPI({'users.info': lambda p: {'ok': True, 'user': {'id': p['user'], 'name': 'alice'}}})
+    try:
+        api = SlackAPI(TOKEN, base_url=server.url)
+        assert api.request('users.info', {'user': 'U1'}).get(5)['user']['name'] == 'alice'
+        assert server.calls == [('users.info', {'user': 'U1', 'token': TOKEN, 'include_locale': 'False'})]
+    finally:
+        server.close()
+
+def test_posts_to_a_channel_keep_order(actors):
+    def post(params):
+        time.sleep(random.random() * 0.02)
+        return {'ok': True}
+    server = FakeAPI({'chat.postMessage': post})
+    try:
+        api = SlackAPI(TOKEN, max_inflight=4, base_url=server.url)
+        futures = [api.request('chat.post_message', {'channel': 'C%d' % (i % 2), 'text': str(i)})
+                for i in range(40)]
+        for f in futures:
+            f.get(10)
+        assert server.posted('C0') == [str(i) for i in range(0, 40, 2)]
+        assert server.posted('C1') == [str(i) for i in range(1, 40, 2)]
+    finally:
+        server.close()
+
+def test_outbox_merges_posts_in_order(actors):
+    def post(params):
+        time.sleep(0.1)
+        return {'ok': True}
+    server = FakeAPI({'chat.postMessage': post})
+    try:
+        outbox = SlackOutbox(SlackAPI(TOKEN, base_url=server.url), rate=100, burst=100)
+        for i in range(10):
+            outbox.post({'channel': 'C1', 'text': str(i)})
+        _wait(lambda: '\n'.join(server.posted()).endswith('9'))
+        assert '\n'.join(server.posted()) == '\n'.join(str(i) for i in range(10))
+        assert len(server.posted()) < 10
+    finally:
+        server.close()
+
+def test_outbox_retries_rate_limited_posts(actors):
+    limited = [True]
+    def post(params):
+        if limited[0]:
+            limited[0] = False
+            return 429, {'Retry-After': '0.2'}, {'ok': False, 'error': 'ratelimited'}
+        return {'ok': True}
+    server = FakeAPI({'chat.postMessage': post})
+    try:
+        outbox = SlackOutbox(SlackAPI(TOKEN, base_url=server.url), merge=False)
+        outbox.post({'channel': 'C1', 'text': 'a'})
+        outbox.post({'channel': 'C1', 'text': 'b'})
+        _wait(lambda: outbox.stats()['sent'] == 2 and not outbox.stats()['depth'])
+        _wait(lambda: len(server.posted()) == 3)
+        assert server.posted() == ['a', 'a', 'b']
+        assert outbox.stats()['rate_limited'] == 1
+    finally:
+        server.close()
+
+class _Scheduler(object):
+    def timer(self, actor, tag, seconds):
+        pass
+
+class _Bot(carnival.ThreadingActor):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.listen('chat:message', self.messages.append)
+
+def _user(params):
+    time.sleep(0.2)
+    return {'ok': True, 'user': {'id': params['user'], 'name': 'bob'}}
+
+# fake RTM server with `api`, the fake Web API Slack connects through
+@pytest.fixture
+def rtm(actors):
+    rtm = FakeRTM()
+    rtm.api = FakeAPI({
+        'rtm.start': _ok(url=rtm.url, team={'id': 'T1', 'name': 'team'},
+            users=[{'id': 'U1', 'name': 'alice'}],
+            channels=[{'id': 'C1', 'name': 'general'}], groups=[], ims=[]),
+        'users.info': _user,
+        'chat.postMessage': _ok(),
+        })
+    rtm.slack = None
+    yield rtm
+    if rtm.slack and rtm.slack._ws:
+        rtm.slack._ws.send('ws:stop')
+    rtm.close()
+    rtm.api.close()
+
+_ids = itertools.count()
+
+# connect Slack to `rtm`; returns a bot receiving chat:message
+def _connect(rtm, **kwargs):
+    rtm.slack = Slack(TOKEN, scheduler=_Scheduler(), id='Slack%d' % next(_ids),
+            api=SlackAPI(TOKEN, base_url=rtm.api.url), **kwargs)
+    bot = _Bot()
+    rtm.slack.add_bot(bot, events=['chat:message'])
+    rtm.send({'type': 'hello'})
+    return bot
+
+def test_rtm_messages_are_delivered_in_order(rtm):
+    bot = _connect(rtm)
+    rtm.send({'type': 'message', 'user': 'U1', 'channel': 'C1', 'text': 'hi <@U2>'})
+    rtm.send({'type': 'message', 'user': 'U1', 'channel': 'C1', 'text': 'a &amp; b'})
+    _wait(lambda: len(bot.messages) == 2)
+    assert [(m['user'], m['channel'], m['text']) for m in bot.messages] == [
+            ('alice', '#general', 'hi @bob'),
+            ('alice', '#general', 'a & b'),
+            ]
+
+    rtm.slack.post('C1', 'bot', 'hello')
+    _wait(lambda: rtm.api.posted() == ['hello'])
+
+def test_uninteresting_frames_are_not_decoded(rtm):
+    decoded = []
+    def loads(data):
+        decoded.append(data)
+        return json.loads(data)
+    bot = _connect(rtm, json_loads=loads)
+    rtm.send({'type': 'user_typing', 'channel': 'C1', 'user': 'U1'})
+    rtm.send({'type': 'message', 'user': 'U1', 'channel': 'C1', 'text': 'hi'})
+    _wait(lambda: bot.messages)
+    assert not [d for d in decoded if 'user_typing' in d]
+
+def test_failing_frame_does_not_drop_its_batch(rtm):
+    bot = _connect(rtm)
+    rtm.slack.send('ws:receive_batch', {'data': [
+        json.dumps({'type': 'message', 'user': 'U1', 'channel': 'C1'}),
+        json.dumps({'type': 'message', 'user': 'U1', 'channel': 'C1', 'text': 'hi'}),
+        ]})
+    _wait(lambda: bot.messages)
+    assert [m['text'] for m in bot.messages] == ['hi']
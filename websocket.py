@@ -2,17 +2,47 @@
 # Author: koichi
 
 # watch given websocket url and send messages to registered consumers.
+#
+# Connections of all WebSockets run as tasks on the event loop shared with
+# AsyncActors, so control messages are handled while connected.
+# Consumers receive
+#   ws:receive  {'data': frame}
+#   ws:receive_batch {'data': [frame, ...]}   instead of ws:receive if
+#               `batch_latency` is given; frames are delivered at most
+#               `batch_latency` sec. after they arrive, or when `batch_size`
+#               frames are buffered
+#   ws:close    {'ws': websocket, 'reason': str}   when the connection is
+#               closed and not reconnected (not after ws:stop)
+#
+# ping_interval, ping_timeout  heartbeat in sec. (None disables it)
+# reconnect                    reconnect after errors waiting for `backoff`
+#                              sec., doubled up to `max_backoff` sec.
+# compression                  False disables permessage-deflate, which is
+#                              negotiated by default
 
 import websockets
 import carnival
+from carnival.logging import logger
 import asyncio
 
-class WebSocket(carnival.ThreadingActor):
-    def __init__(self, url):
-        super().__init__()
+class WebSocket(carnival.AsyncActor):
+    def __init__(self, url, ping_interval=20, ping_timeout=20, reconnect=False,
+            backoff=1, max_backoff=60, compression=True,
+            batch_latency=None, batch_size=100, id=None):
+        super().__init__(id=id)
         self._url = url
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reconnect = reconnect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compression = compression
+        self.batch_latency = batch_latency
+        self.batch_size = batch_size
+        self._batch = []
+        self._flush_handle = None
         self._ws = None
-        self._loop = None
+        self._task = None
         self._consumers = []
 
         self.listen('ws:start', self._start)
@@ -24,21 +54,17 @@ class WebSocket(carnival.ThreadingActor):
         self._cleanup()
 
     def _start(self, mail):
-        self._loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self._loop)
-        self._loop.run_until_complete(self._watch_loop())
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch_loop())
 
     def _stop(self, mail):
         self._cleanup()
 
     def _cleanup(self):
-        if self._loop:
-            self._loop.close()
-            self._loop = None
-        if self._ws:
-            self._ws.close()
-            self._ws = None
         self._consumers = []
+        if self._task:
+            self._task.cancel()
+            self._task = None
 
     def _add_consumer(self, mail):
         self._consumers.append(mail['consumer'])
@@ -48,18 +74,63 @@ class WebSocket(carnival.ThreadingActor):
             self._consumers.remove(mail['consumer'])
 
     def add_consumer(self, actor):
-        self.send('add_consumer', {'consumer': actor})
+        self.send('ws:add_consumer', {'consumer': actor})
 
     def remove_consumer(self, actor):
-        self.send('remove_consumer', {'consumer': actor})
+        self.send('ws:remove_consumer', {'consumer': actor})
 
-    @asyncio.coroutine
-    def _watch_loop(self):
-        self._ws = yield from websockets.connect(self._url)
+    def _connect(self):
+        kwargs = {}
+        if not self.compression:
+            kwargs['compression'] = None
+        return websockets.connect(self._url,
+                ping_interval=self.ping_interval,
+                ping_timeout=self.ping_timeout, **kwargs)
+
+    async def _watch_loop(self):
+        delay = self.backoff
         while True:
-            message = yield from self._ws.recv()
-            if message is None:
+            try:
+                async with self._connect() as ws:
+                    self._ws = ws
+                    delay = self.backoff
+                    async for message in ws:
+                        if self.batch_latency is None:
+                            for consumer in self._consumers:
+                                consumer.send('ws:receive', {'data': message})
+                        else:
+                            self._buffer(message)
+                reason = 'closed'
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                reason = repr(e)
+                logger.warning('WebSocket %s failed: %s', self._url, reason)
+            finally:
+                self._ws = None
+                self._flush()
+            if not self.reconnect:
                 break
-            for bot in self._consumers:
-                bot.send('ws:receive', {'data': message})
-        self._ws = None
+            logger.info('Reconnecting to %s in %.1f sec', self._url, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+        for consumer in self._consumers:
+            consumer.send('ws:close', {'ws': self, 'reason': reason})
+
+    def _buffer(self, message):
+        self._batch.append(message)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                    self.batch_latency, self._flush)
+
+    # the list is shared by consumers and must not be modified
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._batch:
+            batch, self._batch = self._batch, []
+            for consumer in self._consumers:
+                consumer.send('ws:receive_batch', {'data': batch})